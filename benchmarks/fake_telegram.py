@@ -0,0 +1,333 @@
+#Внутрипроцессная подделка той части pyrogram.Client, которой пользуется TgGroupController.
+#Считает запросы (постраничные методы - по страницам), умеет задержку на запрос и FloodWait. Сеть не нужна
+from pyrogram.enums import ChatMemberStatus
+from pyrogram.enums import ChatMembersFilter
+from pyrogram.enums import ChatType
+from pyrogram.errors import FloodWait
+from pyrogram.errors import UserNotParticipant
+from pyrogram.types import ChatPermissions
+from pyrogram.types import ChatPrivileges
+from types import SimpleNamespace
+import asyncio
+import collections
+import copy
+import functools
+import time
+
+DIALOGS_PAGE_SIZE = 100
+MEMBERS_PAGE_SIZE = 200
+MESSAGES_PAGE_SIZE = 100
+PERMISSION_FIELDS = ('can_send_messages', 'can_send_media_messages', 'can_send_other_messages', 'can_send_polls',
+                     'can_add_web_page_previews', 'can_change_info', 'can_invite_users', 'can_pin_messages')
+WRITE_METHODS = ('add_chat_members', 'ban_chat_member', 'unban_chat_member', 'restrict_chat_member', 'promote_chat_member',
+                 'set_administrator_title', 'set_chat_permissions', 'set_chat_title', 'set_chat_description', 'set_chat_photo',
+                 'send_message', 'edit_message_text', 'pin_chat_message', 'create_supergroup', 'delete_supergroup')
+
+
+def _rpc(function):
+    #Как синхронная обертка Pyrogram: внутри работающего цикла событий возвращает корутину, иначе выполняет сразу
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self._before_call(function.__name__)
+            time.sleep(self.latency)
+            return function(self, *args, **kwargs)
+
+        async def call():
+            self._before_call(function.__name__)
+            await asyncio.sleep(self.latency)
+            return function(self, *args, **kwargs)
+        return call()
+    return wrapper
+
+
+class FakeChat:
+    def __init__(self, id, title, chat_type=ChatType.SUPERGROUP):
+        self.id = id
+        self.title = title
+        self.type = chat_type
+        self.description = None
+        self.permissions = ChatPermissions(can_send_messages=True, can_send_media_messages=True, can_send_other_messages=True,
+                                           can_send_polls=True, can_add_web_page_previews=True, can_change_info=False,
+                                           can_invite_users=True, can_pin_messages=False)
+        self.pinned_message = None
+        self.members = collections.OrderedDict() #user_id -> member
+        self.banned = set()
+        self.messages = []
+        self.photo = None
+
+    @property
+    def members_count(self):
+        return len(self.members)
+
+
+class FakeTelegram:
+    def __init__(self, latency=0.0, flood_every=0, flood_value=1, read_flood_every=0):
+        self.latency = latency
+        self.flood_every = flood_every #Каждый N-й запрос на запись получает FloodWait (0 - никогда)
+        self.read_flood_every = read_flood_every #То же для чтения, в том числе для страниц посреди списка
+        self.flood_value = flood_value
+        self._reads = 0
+        self.loop = asyncio.new_event_loop()
+        self.name = 'fake'
+        self.storage = None
+        self.calls = collections.Counter()
+        self.pushed_permissions = [] #Все ChatPermissions из set_chat_permissions и restrict_chat_member, как их передал контроллер
+        self.connections = 0
+        self._writes = 0
+        self._last_id = 1000
+        self.users = {} #username -> user
+        self._users_by_id = {}
+        self.chats = collections.OrderedDict()
+        self.me = SimpleNamespace(id=self._new_id(), username='ansible_service', is_self=True)
+
+    def _new_id(self):
+        self._last_id += 1
+        return self._last_id
+
+    def add_user(self, username):
+        user = SimpleNamespace(id=self._new_id(), username=username, is_self=False)
+        self.users[username.lower()] = user
+        self._users_by_id[user.id] = user
+        return user
+
+    def add_chat(self, title, owned=True, chat_type=ChatType.SUPERGROUP):
+        chat = FakeChat(-100000000000 - self._new_id(), title, chat_type)
+        self.chats[chat.id] = chat
+        status = ChatMemberStatus.OWNER if owned else ChatMemberStatus.MEMBER
+        chat.members[self.me.id] = self._member(self.me, status)
+        return chat
+
+    def add_member(self, chat, user, status=ChatMemberStatus.MEMBER, permissions=None):
+        chat.members[user.id] = self._member(user, status, permissions)
+
+    def _member(self, user, status, permissions=None, privileges=None, custom_title=None):
+        return SimpleNamespace(user=user, status=status, permissions=permissions, privileges=privileges, custom_title=custom_title)
+
+    def _copy_chat(self, chat): #Как и Pyrogram, отдаем копии: изменения на стороне контроллера не меняют "сервер"
+        chat = copy.copy(chat)
+        chat.permissions = copy.copy(chat.permissions)
+        return chat
+
+    def _copy_member(self, member):
+        member = copy.copy(member)
+        member.permissions = copy.copy(member.permissions)
+        member.privileges = copy.copy(member.privileges)
+        return member
+
+    def _applied_permissions(self, permissions): #Как Pyrogram переводит ChatPermissions в ChatBannedRights: None в поле - запрет
+        self.pushed_permissions.append(copy.copy(permissions))
+        return ChatPermissions(**dict((name, bool(getattr(permissions, name))) for name in PERMISSION_FIELDS))
+
+    def _before_call(self, method):
+        self.calls[method] += 1
+        if method in WRITE_METHODS:
+            self._writes += 1
+            if self.flood_every and self._writes % self.flood_every == 0:
+                self._flood()
+        else:
+            self._reads += 1
+            if self.read_flood_every and self._reads % self.read_flood_every == 0:
+                self._flood()
+
+    def _flood(self):
+        raise FloodWait(value=self.flood_value)
+
+    def _user(self, user):
+        if user == 'me':
+            return self.me
+        if isinstance(user, str):
+            user = self.users.get(user.lstrip('@').lower())
+            if user == None:
+                raise ValueError('Username not found')
+            return user
+        if isinstance(user, int):
+            return self.users_by_id(user)
+        return user
+
+    def reset_calls(self): #Подготовка мира тоже идет через запросы - сбрасываем счетчики перед замером
+        self.calls.clear()
+        self.pushed_permissions = []
+        self._writes = 0
+        self._reads = 0
+
+    def rpc_calls(self):
+        return sum(self.calls.values())
+
+    def write_calls(self):
+        return sum(count for method, count in self.calls.items() if method in WRITE_METHODS)
+
+    #Соединение
+    def start(self):
+        self.connections += 1
+
+    def stop(self):
+        pass
+
+    #Постраничные методы: запрос считается на каждую страницу
+    def get_dialogs(self):
+        chats = list(self.chats.values())
+        for start in range(0, max(len(chats), 1), DIALOGS_PAGE_SIZE):
+            self._page('get_dialogs')
+            for chat in chats[start:start + DIALOGS_PAGE_SIZE]:
+                yield SimpleNamespace(chat=self._copy_chat(chat))
+
+    def get_chat_members(self, chat_id, query='', limit=0, filter=None):
+        chat = self.chats[chat_id]
+        if filter == ChatMembersFilter.BANNED:
+            members = [self._member(self.users_by_id(user_id), ChatMemberStatus.BANNED) for user_id in chat.banned]
+        else:
+            members = [member for member in chat.members.values() if query == '' or (member.user.username or '').startswith(query)]
+        for start in range(0, max(len(members), 1), MEMBERS_PAGE_SIZE):
+            self._page('get_chat_members')
+            for member in members[start:start + MEMBERS_PAGE_SIZE]:
+                yield self._copy_member(member)
+
+    def search_messages(self, chat_id, query='', limit=0, from_user=None):
+        messages = [message for message in reversed(self.chats[chat_id].messages) if query in (message.text or '')
+                    and (from_user == None or message.from_user.id == self._user(from_user).id)]
+        if limit:
+            messages = messages[:limit]
+        for start in range(0, max(len(messages), 1), MESSAGES_PAGE_SIZE):
+            self._page('search_messages')
+            for message in messages[start:start + MESSAGES_PAGE_SIZE]:
+                yield message
+
+    def _page(self, method): #Как в Pyrogram, страница запрашивается через invoke - контроллер может его подменить
+        self.loop.run_until_complete(self.invoke(method))
+
+    async def invoke(self, query, *args, **kwargs):
+        self._before_call(query)
+        await asyncio.sleep(self.latency)
+
+    def users_by_id(self, user_id):
+        if user_id == self.me.id:
+            return self.me
+        return self._users_by_id.get(user_id)
+
+    #Одиночные запросы
+    @_rpc
+    def get_chat(self, chat_id):
+        return self._copy_chat(self.chats[chat_id])
+
+    @_rpc
+    def get_chat_member(self, chat_id, user_id):
+        user = self._user(user_id)
+        member = self.chats[chat_id].members.get(user.id)
+        if member == None:
+            raise UserNotParticipant()
+        return self._copy_member(member)
+
+    @_rpc
+    def create_supergroup(self, title, description=None):
+        return self._copy_chat(self.add_chat(title))
+
+    @_rpc
+    def delete_supergroup(self, chat_id):
+        del self.chats[chat_id]
+        return True
+
+    @_rpc
+    def get_messages(self, chat_id, message_ids):
+        messages = self.chats[chat_id].messages
+        if 0 < message_ids <= len(messages):
+            return messages[message_ids - 1]
+        return SimpleNamespace(id=message_ids, empty=True, text=None, from_user=None)
+
+    @_rpc
+    def send_message(self, chat_id, text, **kwargs):
+        return self.post_message(self.chats[chat_id], text, self.me)
+
+    def post_message(self, chat, text, user): #Сообщение от имени любого пользователя - для подготовки мира
+        message = SimpleNamespace(id=len(chat.messages) + 1, text=text, from_user=user, empty=None)
+        chat.messages.append(message)
+        return message
+
+    @_rpc
+    def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        message = self.chats[chat_id].messages[message_id - 1]
+        message.text = text
+        return message
+
+    @_rpc
+    def pin_chat_message(self, chat_id, message_id, disable_notification=False, **kwargs):
+        chat = self.chats[chat_id]
+        chat.pinned_message = chat.messages[message_id - 1]
+        return True
+
+    @_rpc
+    def set_chat_photo(self, chat_id, photo=None, **kwargs):
+        if hasattr(photo, 'read'):
+            photo = photo.read()
+        else:
+            with open(photo, 'rb') as photo_file:
+                photo = photo_file.read()
+        self.chats[chat_id].photo = len(photo)
+        return True
+
+    @_rpc
+    def set_chat_title(self, chat_id, title):
+        self.chats[chat_id].title = title
+        return True
+
+    @_rpc
+    def set_chat_description(self, chat_id, description):
+        self.chats[chat_id].description = description
+        return True
+
+    @_rpc
+    def set_chat_permissions(self, chat_id, permissions):
+        self.chats[chat_id].permissions = self._applied_permissions(permissions)
+        return self._copy_chat(self.chats[chat_id])
+
+    @_rpc
+    def add_chat_members(self, chat_id, user_ids, forward_limit=100):
+        chat = self.chats[chat_id]
+        if not isinstance(user_ids, list):
+            user_ids = [user_ids]
+        users = [self._user(user_id) for user_id in user_ids]
+        for user in users:
+            if user.id in chat.banned:
+                raise ValueError('USER_KICKED')
+        for user in users:
+            chat.members[user.id] = self._member(user, ChatMemberStatus.MEMBER)
+        return True
+
+    @_rpc
+    def ban_chat_member(self, chat_id, user_id, until_date=None):
+        chat = self.chats[chat_id]
+        user = self._user(user_id)
+        chat.members.pop(user.id, None)
+        chat.banned.add(user.id)
+        return True
+
+    @_rpc
+    def unban_chat_member(self, chat_id, user_id):
+        self.chats[chat_id].banned.discard(self._user(user_id).id)
+        return True
+
+    @_rpc
+    def restrict_chat_member(self, chat_id, user_id, permissions, until_date=None):
+        member = self.chats[chat_id].members[self._user(user_id).id]
+        member.permissions = self._applied_permissions(permissions)
+        member.status = ChatMemberStatus.RESTRICTED
+        return self._copy_chat(self.chats[chat_id])
+
+    @_rpc
+    def promote_chat_member(self, chat_id, user_id, privileges=None):
+        member = self.chats[chat_id].members[self._user(user_id).id]
+        privileges = copy.copy(privileges) or ChatPrivileges()
+        if any(value for key, value in vars(privileges).items() if not key.startswith('_') and key != 'is_anonymous'):
+            member.status = ChatMemberStatus.ADMINISTRATOR
+            member.privileges = privileges
+        else:
+            member.status = ChatMemberStatus.MEMBER
+            member.privileges = None
+        return True
+
+    @_rpc
+    def set_administrator_title(self, chat_id, user_id, title):
+        self.chats[chat_id].members[self._user(user_id).id].custom_title = title
+        return True
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+#Офлайн-бенчмарки group_keeper на поддельном Telegram (benchmarks/fake_telegram.py).
+#Для каждого сценария печатает время, число запросов (всего и на запись), пиковую память,
+#и завершается с кодом 1, если результат сценария не прошел проверку или превышен бюджет запросов.
+#Нужны pyrogram и ansible-core (как и самому модулю), сеть не нужна.
+#
+#    python benchmarks/run_benchmarks.py [--latency 0.01] [--only converged] [--json]
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+COLLECTION_ROOT = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+FAST_RATES = {'read': (1000000, 1000000), 'write': (1000000, 1000000), 'upload': (1000000, 1000000)} #Лимиты не должны влиять на замеры
+
+
+def make_collection_importable(): #Коллекция импортируется как ansible_collections.avant_it.telegram, даже если лежит не в collections path
+    try:
+        import ansible_collections.avant_it.telegram.plugins.module_utils.tggroupcontroller
+        return
+    except ImportError:
+        pass
+    root = tempfile.mkdtemp(prefix='tg_benchmarks_')
+    os.makedirs(os.path.join(root, 'ansible_collections', 'avant_it'))
+    os.symlink(COLLECTION_ROOT, os.path.join(root, 'ansible_collections', 'avant_it', 'telegram'))
+    sys.path.insert(0, root)
+
+
+make_collection_importable()
+
+from ansible_collections.avant_it.telegram.plugins.module_utils.tggroupcontroller import TgGroupController
+from ansible_collections.avant_it.telegram.plugins.module_utils.tggroupcontroller import METADATA_PREFIX
+from ansible_collections.avant_it.telegram.plugins.modules.group_keeper import reconcile
+from ansible_collections.avant_it.telegram.plugins.modules.group_keeper import module_spec
+from ansible.module_utils.common.arg_spec import ArgumentSpecValidator
+from fake_telegram import FakeTelegram
+import fake_telegram
+from pyrogram.enums import ChatType
+
+PERMISSION_NAMES = ('can_send_messages', 'can_send_media_messages', 'can_send_other_messages', 'can_send_polls',
+                    'can_add_webpage_preview', 'can_change_info', 'can_invite_users', 'can_pin_messages')
+
+
+def user_spec(name, permissions=None, **overrides): #Элемент users так, как его пишут в плейбуке: значения по умолчанию подставит module_params
+    spec = {'name': name}
+    if permissions != None:
+        spec['permissions'] = dict(permissions)
+    spec.update(overrides)
+    return spec
+
+
+def module_params(**overrides): #Параметры проходят ту же проверку, что в AnsibleModule, reconcile получает их в том же виде, что и в модуле
+    params = {'session_string': 'fake', 'group_title': 'Benchmark group'}
+    params.update(overrides)
+    validation = ArgumentSpecValidator(**module_spec()).validate(dict((key, value) for key, value in params.items() if value != None))
+    if validation.error_messages:
+        raise ValueError('Invalid benchmark parameters: ' + ', '.join(validation.error_messages))
+    return validation.validated_parameters
+
+
+def build_world(telegram, dialogs, members, desired, joined):
+    #dialogs диалогов (группа для бенчмарка - последняя), в ней members посторонних участников;
+    #desired пользователей для users, из них первые joined уже состоят в группе
+    for index in range(dialogs - 1):
+        telegram.add_chat('Other chat ' + str(index), owned=index % 2 == 0, chat_type=ChatType.SUPERGROUP if index % 3 else ChatType.PRIVATE)
+    chat = telegram.add_chat('Benchmark group')
+    chat.description = 'Benchmark'
+    message = telegram.send_message(chat.id, METADATA_PREFIX + json.dumps({'group_id': chat.id, 'image_hash': None}))
+    telegram.pin_chat_message(chat.id, message.id)
+    for index in range(members):
+        telegram.add_member(chat, telegram.add_user('member_' + str(index)))
+    names = []
+    for index in range(desired):
+        user = telegram.add_user('user_' + str(index))
+        if index < joined:
+            telegram.add_member(chat, user)
+        names.append(user.username)
+    telegram.reset_calls()
+    return chat, names
+
+
+def scenario_converged(telegram, size): #Заданные права совпадают с текущими, в том числе опция с другим именем в Pyrogram
+    chat, names = build_world(telegram, size['dialogs'], size['members'], size['desired'], size['desired'])
+    return [module_params(group_description='Benchmark', users=[user_spec(name, {'can_pin_messages': False, 'can_add_webpage_preview': True}) for name in names])]
+
+
+def scenario_cold(telegram, size):
+    chat, names = build_world(telegram, size['dialogs'], size['members'], size['desired'], 0)
+    return [module_params(group_description='Benchmark', users=[user_spec(name) for name in names])]
+
+
+def scenario_cold_permissions(telegram, size):
+    chat, names = build_world(telegram, size['dialogs'], size['members'], size['desired'], 0)
+    users = []
+    for index, name in enumerate(names):
+        if index % 10 == 0:
+            users.append(user_spec(name, {'can_pin_messages': True}))
+        else:
+            users.append(user_spec(name, {'can_send_polls': False}))
+    return [module_params(group_description='Benchmark', optimize_permissions=True, users=users)]
+
+
+def scenario_flood(telegram, size):
+    chat, names = build_world(telegram, size['dialogs'], size['members'], size['desired'], size['desired'])
+    telegram.flood_every = 10
+    users = [user_spec(name, {'can_send_polls': index >= 20}) for index, name in enumerate(names)]
+    return [module_params(group_description='Benchmark', users=users)]
+
+
+def scenario_flood_pages(telegram, size): #FloodWait на страницах посреди списков: проход продолжается, а не падает
+    chat, names = build_world(telegram, size['dialogs'], size['members'], size['desired'], size['desired'])
+    telegram.read_flood_every = 25
+    return [module_params(group_description='Benchmark', users=[user_spec(name, {'can_pin_messages': False}) for name in names])]
+
+
+def scenario_long_flood(telegram, size): #FloodWait длиннее max_flood_wait - ошибка в результате, со счетчиками запросов
+    chat, names = build_world(telegram, size['dialogs'], size['members'], size['desired'], size['desired'])
+    telegram.flood_every = 1
+    telegram.flood_value = 1000
+    return [module_params(group_description='Changed', users=[user_spec(name) for name in names])]
+
+
+def scenario_long_flood_groups(telegram, size): #Долгий FloodWait на первой группе: остальные группы отмечаются без запросов
+    chat, names = build_world(telegram, size['dialogs'], size['members'], size['desired'], size['desired'])
+    telegram.flood_every = 1
+    telegram.flood_value = 1000
+    group = {'group_title': 'Benchmark group', 'group_description': 'Changed'}
+    return [module_params(group_title=None, groups=[group] * 50)]
+
+
+def scenario_exclusive(telegram, size): #Все посторонние участники удаляются
+    chat, names = build_world(telegram, size['dialogs'], size['members'], size['desired'], size['desired'])
+    return [module_params(group_description='Benchmark', exclusive=True, users=[user_spec(name, {'can_pin_messages': False}) for name in names])]
+
+
+def scenario_converged_cached(telegram, size):
+    chat, names = build_world(telegram, size['dialogs'], size['members'], size['desired'], size['desired'])
+    params = module_params(group_description='Benchmark', state_cache=os.path.join(tempfile.mkdtemp(prefix='tg_state_'), 'state.json'),
+                           users=[user_spec(name, {'can_pin_messages': False}) for name in names])
+    return [params, params] #Первый прогон заполняет кэш, замеряется второй
+
+
+def scenario_admin_pin(telegram, size): #Администратор закрепил свое сообщение поверх метаданных: картинка не перезаливается, закреп не перебивается
+    chat, names = build_world(telegram, size['dialogs'], size['members'], size['desired'], size['desired'])
+    image = os.path.join(tempfile.mkdtemp(prefix='tg_image_'), 'group.png')
+    with open(image, 'wb') as image_file:
+        image_file.write(b'benchmark image')
+    metadata = chat.pinned_message
+    metadata.text = METADATA_PREFIX + json.dumps({'group_id': chat.id, 'image_hash': hashlib.md5(b'benchmark image').hexdigest()})
+    chat.pinned_message = telegram.post_message(chat, 'Rules of the group', telegram.add_user('human_admin'))
+    return [module_params(group_description='Benchmark', group_image=image, users=[user_spec(name, {'can_pin_messages': False}) for name in names])]
+
+
+def scenario_new_group_permissions(telegram, size): #Новая группа с правами по умолчанию и правами участников: записываются полные наборы прав
+    chat, names = build_world(telegram, size['dialogs'], 0, size['desired'], 0)
+    defaults = dict((key, None) for key in PERMISSION_NAMES)
+    defaults['can_send_polls'] = False
+    users = [user_spec(name, {'can_pin_messages': True} if index % 10 == 0 else None) for index, name in enumerate(names)]
+    return [module_params(group_title='New group', group_description='Created', default_group_permissions=defaults, users=users)]
+
+
+def scenario_legacy_metadata(telegram, size): #Группа без сообщения с метаданными (старый формат): первый прогон пишет их, второй обходится без поиска
+    chat, names = build_world(telegram, size['dialogs'], size['members'], size['desired'], size['desired'])
+    chat.messages = []
+    chat.pinned_message = None
+    telegram.post_message(chat, 'image_hash:' + hashlib.md5(b'old image').hexdigest(), telegram.me)
+    params = module_params(group_description='Benchmark', users=[user_spec(name, {'can_pin_messages': False}) for name in names])
+    return [params, params]
+
+
+def expect_success(telegram, failed, msg, result): #Проверки результата сценария: None - все в порядке, иначе описание проблемы
+    if failed:
+        return str(msg)
+
+
+def expect_admin_pin_kept(telegram, failed, msg, result):
+    if failed:
+        return str(msg)
+    chat = [chat for chat in telegram.chats.values() if chat.title == 'Benchmark group'][0]
+    if chat.pinned_message.from_user.username != 'human_admin':
+        return 'the administrator\'s pinned message was replaced'
+
+
+def expect_full_permissions(telegram, failed, msg, result): #В записанных правах нет None, а в группе ничего лишнего не запрещено
+    if failed:
+        return str(msg)
+    for permissions in telegram.pushed_permissions:
+        unset = [name for name in fake_telegram.PERMISSION_FIELDS if getattr(permissions, name) == None]
+        if len(unset) > 0:
+            return 'permissions pushed with unset fields (banned by Pyrogram): ' + ', '.join(unset)
+    chat = [chat for chat in telegram.chats.values() if chat.title == 'New group'][0]
+    if chat.permissions.can_send_polls or not chat.permissions.can_send_messages:
+        return 'wrong default permissions of the new group: ' + str(chat.permissions)
+    restricted = [member for member in chat.members.values() if member.permissions != None]
+    if len(restricted) == 0 or any(not member.permissions.can_pin_messages or not member.permissions.can_send_messages for member in restricted):
+        return 'wrong member permissions in the new group'
+
+
+def expect_counted_flood_waits(telegram, failed, msg, result): #FloodWait, пережитые внутри страниц, тоже в счетчиках
+    if failed:
+        return str(msg)
+    if result['request_stats']['flood_waits'] == 0 or result['request_stats']['wait_seconds'] == 0:
+        return 'FloodWaits slept through inside pages are missing from request_stats: ' + str(result['request_stats'])
+
+
+def expect_all_groups_failed(telegram, failed, msg, result):
+    if not failed or not all(changes.get('failed') for changes in result['message']):
+        return 'expected every group to fail after a long FloodWait, got failed=' + str(failed)
+
+
+def expect_no_message_search(telegram, failed, msg, result):
+    if failed:
+        return str(msg)
+    if telegram.calls['search_messages'] > 0:
+        return 'metadata is still looked up with search_messages after it was written'
+
+
+def expect_failure_with_stats(telegram, failed, msg, result):
+    if not failed or 'request_stats' not in result:
+        return 'expected a failed result with request_stats, got failed=' + str(failed)
+
+
+SIZE = {'dialogs': 1000, 'members': 5000, 'desired': 500}
+
+#(подготовка, бюджеты запросов[, проверка результата]). Постраничные методы считаются по страницам (100 диалогов, 200 участников)
+SCENARIOS = {
+    'converged': (scenario_converged, {'rpc': 44, 'write': 0}),
+    'cold': (scenario_cold, {'rpc': 46, 'write': 3}),
+    'cold_permissions': (scenario_cold_permissions, {'rpc': 97, 'write': 54}),
+    'flood': (scenario_flood, {'rpc': 65, 'write': 22}),
+    'flood_pages': (scenario_flood_pages, {'rpc': 45, 'write': 0}, expect_counted_flood_waits),
+    'long_flood': (scenario_long_flood, {'rpc': 44, 'write': 1}, expect_failure_with_stats),
+    'long_flood_groups': (scenario_long_flood_groups, {'rpc': 13, 'write': 1}, expect_all_groups_failed),
+    'exclusive': (scenario_exclusive, {'rpc': 5044, 'write': 5000}),
+    'converged_cached': (scenario_converged_cached, {'rpc': 2, 'write': 0}),
+    'legacy_metadata': (scenario_legacy_metadata, {'rpc': 40, 'write': 0}, expect_no_message_search),
+    'admin_pin': (scenario_admin_pin, {'rpc': 45, 'write': 0}, expect_admin_pin_kept),
+    'new_group_perms': (scenario_new_group_permissions, {'rpc': 70, 'write': 60}, expect_full_permissions),
+}
+
+
+def run_scenario(name, latency):
+    build, budget = SCENARIOS[name][:2]
+    check = SCENARIOS[name][2] if len(SCENARIOS[name]) > 2 else expect_success
+    telegram = FakeTelegram(latency=latency, flood_value=1)
+    runs = build(telegram, SIZE)
+    for index, params in enumerate(runs):
+        controller = TgGroupController(params['session_string'], concurrency=params['concurrency'], state_cache=params['state_cache'], rates=FAST_RATES)
+        controller._conn = telegram
+        measured = index == len(runs) - 1
+        if measured:
+            telegram.reset_calls()
+            tracemalloc.start()
+            started = time.perf_counter()
+        with controller:
+            failed, msg, result = reconcile(controller, params)
+        if measured:
+            wall = time.perf_counter() - started
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    report = {'scenario': name,
+              'failed': failed,
+              'msg': msg,
+              'changed': result['changed'],
+              'wall_seconds': round(wall, 3),
+              'peak_memory_mb': round(peak / 1024.0 / 1024.0, 2),
+              'rpc': telegram.rpc_calls(),
+              'write': telegram.write_calls(),
+              'calls': dict(telegram.calls),
+              'request_stats': result.get('request_stats'),
+              'budget': budget}
+    report['over_budget'] = [key for key in budget if report[key] > budget[key]]
+    report['problem'] = check(telegram, failed, msg, result)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline group_keeper benchmarks')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per request')
+    parser.add_argument('--only', action='append', choices=sorted(SCENARIOS), help='run only these scenarios')
+    parser.add_argument('--json', action='store_true', help='print reports as JSON lines')
+    args = parser.parse_args()
+
+    ok = True
+    for name in args.only or list(SCENARIOS):
+        report = run_scenario(name, args.latency)
+        if report['problem'] != None or report['over_budget']:
+            ok = False
+        if args.json:
+            print(json.dumps(report, default=str))
+        else:
+            status = 'FAIL' if report['problem'] != None else ('OVER BUDGET: ' + ', '.join(report['over_budget']) if report['over_budget'] else 'ok')
+            print('%-18s %8.3fs  rpc %5d/%-5d write %4d/%-4d peak %7.2f MB  %s' % (
+                name, report['wall_seconds'], report['rpc'], report['budget']['rpc'], report['write'], report['budget']['write'],
+                report['peak_memory_mb'], status))
+            if report['problem'] != None:
+                print('    ' + report['problem'])
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#Время запуска модуля: импорт group_keeper (то, что платит каждая задача, в том числе через брокер и при ошибке аргументов)
+#и создание контроллера, которому уже нужен Pyrogram. Каждый замер - в свежем интерпретаторе, берется медиана.
+#Завершается с кодом 1, если импорт модуля загрузил Pyrogram или медиана импорта больше --budget секунд.
+#
+#    python benchmarks/startup.py [--runs 10] [--budget 0.5]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+COLLECTION_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEASURE = r'''
+import json, os, sys, time, tempfile
+root = tempfile.mkdtemp(prefix='tg_startup_')
+os.makedirs(os.path.join(root, 'ansible_collections', 'avant_it'))
+os.symlink(%(collection)r, os.path.join(root, 'ansible_collections', 'avant_it', 'telegram'))
+sys.path.insert(0, root)
+started = time.perf_counter()
+from ansible_collections.avant_it.telegram.plugins.modules import group_keeper
+imported = time.perf_counter()
+pyrogram_loaded = 'pyrogram' in sys.modules
+controller = group_keeper.TgGroupController('startup')
+created = time.perf_counter()
+from ansible_collections.avant_it.telegram.plugins.module_utils.tggroupcontroller import crypto_backend
+print(json.dumps({'import': imported - started, 'controller': created - imported,
+                  'pyrogram_on_import': pyrogram_loaded, 'crypto_backend': crypto_backend()}))
+'''
+
+
+def measure_once():
+    output = subprocess.run([sys.executable, '-c', MEASURE % {'collection': COLLECTION_ROOT}],
+                            check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='group_keeper startup time')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget', type=float, default=0.5, help='maximum median seconds to import the module')
+    args = parser.parse_args()
+
+    runs = [measure_once() for _ in range(args.runs)]
+    report = {'import_seconds': round(statistics.median(run['import'] for run in runs), 4),
+              'controller_seconds': round(statistics.median(run['controller'] for run in runs), 4),
+              'pyrogram_on_import': any(run['pyrogram_on_import'] for run in runs),
+              'crypto_backend': runs[-1]['crypto_backend']}
+    print(json.dumps(report))
+    if report['pyrogram_on_import'] or report['import_seconds'] > args.budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import tempfile
+import time
+
+BROKER_PROTOCOL = 2 #Меняется при несовместимых изменениях запроса/ответа, старые брокеры тогда не используются
+
+
+def broker_socket_path(session_string): #Один брокер на сессию: два клиента с одним ключом авторизации Telegram не допускает (AUTH_KEY_DUPLICATED).
+    #Каталог доступен только владельцу
+    key = hashlib.sha256(json.dumps([BROKER_PROTOCOL, session_string]).encode()).hexdigest()[:32]
+    directory = os.path.join(tempfile.gettempdir(), 'ansible-telegram-' + str(os.getuid()))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    directory_stat = os.stat(directory)
+    if directory_stat.st_uid != os.getuid() or directory_stat.st_mode & 0o077:
+        raise RuntimeError('Broker directory ' + directory + ' must belong to the current user and have mode 0700')
+    return os.path.join(directory, key + '.sock')
+
+
+def _preload_modules():
+    #AnsiballZ удаляет архив с module_utils после задачи, а брокер живет дольше: все, что контроллер импортирует лениво
+    #(Pyrogram, кэш пиров), импортируется до того, как брокер начнет принимать запросы
+    from ansible_collections.avant_it.telegram.plugins.module_utils import tgcontrollerpool
+    from ansible_collections.avant_it.telegram.plugins.module_utils import tggroupcontroller
+    from ansible_collections.avant_it.telegram.plugins.module_utils import tgpeerstorage
+    from ansible_collections.avant_it.telegram.plugins.module_utils import tgprofiler
+    from ansible_collections.avant_it.telegram.plugins.module_utils import tgscheduler
+    from ansible_collections.avant_it.telegram.plugins.module_utils import tgstatecache
+    tggroupcontroller._load_pyrogram()
+    tgscheduler._load_errors()
+
+
+def _send(connection, payload):
+    connection.sendall(json.dumps(payload).encode() + b'\n')
+
+
+def _receive(connection):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = connection.recv(65536)
+        if not chunk:
+            return None
+        data += chunk
+    return json.loads(data)
+
+
+class TgBroker:
+    #Фоновый процесс: держит авторизованный контроллер (индекс диалогов, кэши) между задачами Ansible.
+    #Запросы обрабатываются по одному. Если запросов нет idle_timeout секунд - завершается
+    def __init__(self, path, controller_factory, handler, idle_timeout=300):
+        self.path = path
+        self.controller_factory = controller_factory #controller_factory(options) - настройки контроллера приходят с каждым запросом
+        self.handler = handler
+        self.idle_timeout = idle_timeout
+        self._controller = None
+        self._options = None
+
+    def serve(self):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(self.path)
+        except OSError:
+            listener.close() #Брокер уже запущен другой задачей
+            return
+        socket_inode = os.stat(self.path).st_ino
+        try:
+            os.chmod(self.path, 0o600)
+            listener.listen(16)
+            listener.settimeout(self.idle_timeout)
+            while True:
+                try:
+                    connection, address = listener.accept()
+                except socket.timeout:
+                    break
+                with connection:
+                    connection.settimeout(None)
+                    request = _receive(connection)
+                    if request != None:
+                        _send(connection, self._handle(request))
+        finally:
+            listener.close()
+            try:
+                if os.stat(self.path).st_ino == socket_inode:
+                    os.unlink(self.path)
+            except OSError:
+                pass
+            self._close_controller()
+
+    def _handle(self, request):
+        try:
+            os.chdir(request['cwd'])
+            if self._controller != None and request['options'] != self._options:
+                self._close_controller() #Другие настройки - пересоздаем контроллер, старое подключение закрывается до нового
+            if self._controller == None:
+                self._controller = self.controller_factory(request['options'])
+                self._options = request['options']
+            self._controller.reset_request_stats()
+            self._controller.expire_dialog_index() #Между задачами аккаунт мог вступить в новые группы
+            response = self.handler(self._controller, request)
+            self._controller.flush()
+            return response
+        except Exception as e:
+            self._close_controller() #После неожиданной ошибки начинаем со свежего подключения
+            return {'failed': True, 'msg': 'Broker error: ' + repr(e), 'result': {}}
+
+    def _close_controller(self):
+        if self._controller != None:
+            controller = self._controller
+            self._controller = None
+            try:
+                controller.close()
+            except Exception:
+                pass
+
+    def start(self): #Двойной fork: брокер отвязан от процесса модуля и не держит его stdout, иначе Ansible ждал бы его завершения
+        pid = os.fork()
+        if pid != 0:
+            os.waitpid(pid, 0)
+            return
+        try:
+            os.setsid()
+            if os.fork() != 0:
+                os._exit(0)
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            _preload_modules() #Пока модуль ждет брокера, архив AnsiballZ еще на месте
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            self.serve()
+        finally:
+            os._exit(0)
+
+
+def call_broker(session_string, options, request, controller_factory, handler, idle_timeout=300, start_timeout=30):
+    #Отправляет запрос брокеру; если его нет - запускает. Возвращает ответ handler'а
+    path = broker_socket_path(session_string)
+    request = dict(request, cwd=os.getcwd(), options=options)
+    started = False
+    deadline = None
+    while True:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(path)
+            _send(connection, request)
+            response = _receive(connection)
+            if response == None:
+                raise RuntimeError('Broker closed the connection without a response')
+            return response
+        except (FileNotFoundError, ConnectionRefusedError):
+            if not started:
+                try:
+                    os.unlink(path) #Сокет остался от завершившегося брокера
+                except FileNotFoundError:
+                    pass
+                TgBroker(path, controller_factory, handler, idle_timeout).start()
+                started = True
+                deadline = time.monotonic() + start_timeout
+            elif time.monotonic() > deadline:
+                raise RuntimeError('Broker did not start within ' + str(start_timeout) + ' seconds')
+            time.sleep(0.05)
+        finally:
+            connection.close()
@@ -0,0 +1,136 @@
+from ansible_collections.avant_it.telegram.plugins.module_utils.tggroupcontroller import TgGroupController
+import base64
+import hashlib
+import struct
+
+PER_ACCOUNT_CACHES = ('state_cache', 'peer_cache') #Эти кэши привязаны к аккаунту, у каждого аккаунта свой файл
+
+
+def _account_path(path, session_string):
+    return path + '.' + hashlib.sha256(session_string.encode()).hexdigest()[:12]
+
+
+def _session_user_id(session_string): #id аккаунта прямо из session_string Pyrogram (в том числе старого формата), без подключения
+    from pyrogram.storage import Storage
+    data = base64.urlsafe_b64decode(session_string + '=' * (-len(session_string) % 4))
+    if len(session_string) == Storage.SESSION_STRING_SIZE:
+        layout = Storage.OLD_SESSION_STRING_FORMAT
+    elif len(session_string) == Storage.SESSION_STRING_SIZE_64:
+        layout = Storage.OLD_SESSION_STRING_FORMAT_64
+    else:
+        layout = Storage.SESSION_STRING_FORMAT
+    return struct.unpack(layout, data)[-2] #Во всех форматах user_id - предпоследнее поле
+
+
+class TgControllerPool:
+    #Несколько аккаунтов Telegram. Каждую группу обрабатывает один аккаунт - наименее загруженный из тех,
+    #кто в ней владелец или администратор. Если аккаунт получил FloodWait длиннее max_flood_wait - группа
+    #обрабатывается заново другим подходящим аккаунтом
+    def __init__(self, session_strings, **controller_options):
+        if len(session_strings) == 0:
+            raise ValueError('session_strings must contain at least one session')
+        self.controllers = []
+        user_ids = [_session_user_id(session_string) for session_string in session_strings] #Аккаунты пула не удаляют друг друга из групп
+        for session_string in session_strings:
+            options = dict(controller_options, pool_user_ids=user_ids)
+            for name in PER_ACCOUNT_CACHES:
+                if options.get(name) != None:
+                    options[name] = _account_path(options[name], session_string)
+            self.controllers.append(TgGroupController(session_string, **options))
+        self.fallbacks = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for controller in self.controllers:
+            controller.close()
+
+    def flush(self):
+        for controller in self.controllers:
+            controller.flush()
+
+    def get_request_stats(self): #Сумма по аккаунтам
+        stats = {'accounts': len(self.controllers), 'fallbacks': self.fallbacks}
+        for controller in self.controllers:
+            for key, value in controller.get_request_stats().items():
+                stats[key] = round(stats.get(key, 0) + value, 3)
+        return stats
+
+    def get_load(self): #Нагрузка самого свободного аккаунта: пул под долгим FloodWait, только если под ним все аккаунты
+        return min(controller.get_load() for controller in self.controllers)
+
+    def reset_request_stats(self):
+        self.fallbacks = 0
+        for controller in self.controllers:
+            controller.reset_request_stats()
+
+    def expire_dialog_index(self):
+        for controller in self.controllers:
+            controller.expire_dialog_index()
+
+    def get_profile(self): #None, если профилирование выключено. Иначе отчеты по аккаунтам в порядке session_strings
+        profiles = [controller.get_profile() for controller in self.controllers]
+        if profiles[0] == None:
+            return None
+        return {'accounts': profiles}
+
+    def write_profile(self, path, report, extra=None):
+        self.controllers[0].write_profile(path, report, extra)
+
+    def _by_load(self, exclude=()):
+        candidates = [controller for controller in self.controllers if controller not in exclude]
+        return sorted(candidates, key=lambda controller: controller.get_load())
+
+    def select(self, title, id=None, exclude=(), owner=False): #Возвращает (controller, group). Если группы нет ни у одного аккаунта - ее создаст наименее загруженный
+        creator = None
+        seen = False
+        flood_wait = None
+        for controller in self._by_load(exclude):
+            long_flood_waits = controller.get_request_stats()['long_flood_waits']
+            try:
+                group = controller.get_group_obj(title=title, id=id)
+                rights = controller.get_self_rights(group) if group.exists else None
+            except Exception as e:
+                if controller.get_request_stats()['long_flood_waits'] == long_flood_waits:
+                    raise
+                flood_wait = e #Аккаунт под долгим FloodWait - смотрим следующие
+                continue
+            if group.exists:
+                seen = True
+                if rights.is_owner or (rights.is_admin and not owner):
+                    if flood_wait != None:
+                        self.fallbacks += 1
+                    return controller, group
+            elif creator == None:
+                creator = controller, group
+        if flood_wait != None: #Группа могла быть у аккаунта под FloodWait - создавать ее заново или говорить, что прав нет, нельзя
+            raise flood_wait
+        if seen or creator == None: #Группа есть, но прав на нее нет - создавать вторую такую же нельзя
+            raise ValueError('None of the accounts is ' + ('the owner' if owner else 'an owner or administrator') + ' of group ' + str(title or id))
+        return creator
+
+    def run(self, title, id, function, owner=False): #function(controller, group). При долгом FloodWait, в том числе при выборе аккаунта, повторяет на другом
+        tried = []
+        error = None
+        while True:
+            try:
+                controller, group = self.select(title, id, exclude=tried, owner=owner)
+            except ValueError:
+                if error == None:
+                    raise
+                raise error
+            if error != None:
+                self.fallbacks += 1
+            existed = group.exists #Группу, которую успели создать, другие аккаунты не видят - повторять нельзя
+            long_flood_waits = controller.get_request_stats()['long_flood_waits']
+            try:
+                return function(controller, group)
+            except Exception as e:
+                tried.append(controller)
+                if controller.get_request_stats()['long_flood_waits'] == long_flood_waits or not existed:
+                    raise
+                error = e
@@ -1,17 +1,73 @@
-from pyrogram.client import Client
-from pyrogram.types import ChatPermissions
-from pyrogram.types import ChatPrivileges
-from pyrogram.enums import ChatMemberStatus
+from ansible_collections.avant_it.telegram.plugins.module_utils.tgscheduler import TgRequestScheduler
+from ansible_collections.avant_it.telegram.plugins.module_utils.tgstatecache import TgStateCache
+from ansible_collections.avant_it.telegram.plugins.module_utils.tgprofiler import TgProfiler
 import hashlib
+import copy
+import importlib.util
+import json
+import os
+import asyncio
+import inspect
+import sys
+import time
+
+#Pyrogram импортируется только при создании контроллера (_load_pyrogram): его импорт - основная часть времени запуска модуля
+Client = None
+ChatPermissions = None
+ChatPrivileges = None
+ChatMemberStatus = None
+ChatMembersFilter = None
+
+IMAGE_CHUNK_SIZE = 1024 * 1024
+NOT_PROFILED_METHODS = ('_profile_methods', '_call', '_iterate', '_sleep_through_flood_waits', '_request', '_connect', 'get_profile', 'write_profile', 'get_request_stats', 'reset_request_stats', 'get_load')
+METADATA_PREFIX = 'ansible_metadata:'
+ADD_MEMBERS_CHUNK_SIZE = 200 #Сколько пользователей Telegram принимает в одном InviteToChannel
+FIELD_ALIASES = {'can_add_webpage_preview': 'can_add_web_page_previews'} #Опции модуля, которые в Pyrogram называются иначе
+_CONSTRUCTOR_FIELDS = {} #Тип объекта Pyrogram -> параметры конструктора
+
+def _constructor_fields(object):
+    if type(object) not in _CONSTRUCTOR_FIELDS:
+        _CONSTRUCTOR_FIELDS[type(object)] = [name for name in inspect.signature(type(object).__init__).parameters if name != 'self']
+    return _CONSTRUCTOR_FIELDS[type(object)]
+
+def _load_pyrogram():
+    global Client, ChatPermissions, ChatPrivileges, ChatMemberStatus, ChatMembersFilter
+    if Client == None:
+        from pyrogram.client import Client
+        from pyrogram.types import ChatPermissions
+        from pyrogram.types import ChatPrivileges
+        from pyrogram.enums import ChatMemberStatus
+        from pyrogram.enums import ChatMembersFilter
+
+
+def crypto_backend(): #'tgcrypto', если Pyrogram шифрует через TgCrypto, иначе 'python' (чистый Python, в разы медленнее)
+    aes = sys.modules.get('pyrogram.crypto.aes')
+    if aes != None:
+        return 'tgcrypto' if hasattr(aes, 'tgcrypto') else 'python'
+    return 'tgcrypto' if importlib.util.find_spec('tgcrypto') != None else 'python'
+
 
 class TgMember:
+    __slots__ = ('username', 'is_admin', 'is_restricted', 'admin_title', 'permissions', 'privileges') #В снимках больших групп таких объектов десятки тысяч
+
     def __init__(self):
         self.username = None
         self.is_admin = None
+        self.is_restricted = False
         self.admin_title = None
         self.permissions = None
         self.privileges = None
 
+class TgRights: #Наши права в группе
+    def __init__(self):
+        self.is_owner = False
+        self.is_admin = False
+        self.can_change_info = False
+        self.can_restrict_members = False
+        self.can_promote_members = False
+        self.can_invite_users = False
+        self.can_pin_messages = False
+
 class TgGroup:
     def __init__(self):
         self.id = None
@@ -20,8 +76,13 @@ class TgGroup:
         self.image_hash = None
         self.description = None
         self.members_list = None
+        self.unlisted_members = None
         self.chat_permissions = None
+        self.metadata_message_id = None
+        self.metadata_editable = True #False - сообщение с метаданными написал другой аккаунт пула, править его нельзя
+        self.members_count = None
         self.ownership = False
+        self.rights = None
         self.exists = False
         
         def validate(self):
@@ -30,38 +91,306 @@ class TgGroup:
 
 
 class TgGroupController:
-    def __init__(self, session_string):
-        self._conn = Client('Telegram Ansible Module', session_string=session_string, in_memory=True)
-
-        
+    def __init__(self, session_string, concurrency=8, max_flood_wait=300, image_hash_cache=None,
+                 state_cache=None, state_cache_ttl=86400, state_cache_revalidate=True, peer_cache=None, peer_cache_ttl=None, profile=False, rates=None, pool_user_ids=()):
+        _load_pyrogram()
+        self.pool_user_ids = frozenset(pool_user_ids) #id всех аккаунтов пула: их не удаляем из групп и их метаданные считаем своими
+        self._conn = Client('Telegram Ansible Module', session_string=session_string, in_memory=True, sleep_threshold=0) #FloodWait пережидает планировщик
+        forget_peers = None
+        self._peer_cache = peer_cache
+        if peer_cache != None:
+            from ansible_collections.avant_it.telegram.plugins.module_utils.tgpeerstorage import TgPeerStorage
+            self._conn.storage = TgPeerStorage(self._conn.name, session_string, peer_cache, username_ttl=peer_cache_ttl)
+            forget_peers = self._conn.storage.forget_usernames
+        self._connected = False
+        self.concurrency = max(1, concurrency)
+        self._profiler = None
+        if profile:
+            self._profiler = TgProfiler()
+            self._profile_methods()
+        self._scheduler = TgRequestScheduler(rates=rates, max_flood_wait=max_flood_wait, forget_peers=forget_peers, profiler=self._profiler)
+        self._dialogs_by_id = None
+        self._dialogs_by_title = None
+        self._dialogs_expired = False
+        self.image_hash_cache = image_hash_cache
+        self._image_hashes = None
+        self._state_cache = None
+        if state_cache != None:
+            self._state_cache = TgStateCache(state_cache, ttl=state_cache_ttl)
+        self.state_cache_revalidate = state_cache_revalidate
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _profile_methods(self): #Оборачивает методы контроллера замерами. Без профилирования методы остаются как есть
+        for name, function in vars(TgGroupController).items():
+            if inspect.isfunction(function) and not name.startswith('__') and name not in NOT_PROFILED_METHODS \
+                    and not inspect.iscoroutinefunction(function):
+                setattr(self, name, self._profiler.wrap('controller.' + name, getattr(self, name)))
+
+    def _connect(self): #Открывает соединение при первом обращении, дальше переиспользует его
+        if not self._connected:
+            started = time.perf_counter()
+            self._conn.start()
+            self._connected = True
+            if self._profiler != None:
+                self._profiler.connections += 1
+                self._profiler.connect_seconds += time.perf_counter() - started
+        return self._conn
+
+    def close(self): #Закрывает соединение, если оно было открыто, и сохраняет кэш состояния
+        if self._state_cache != None:
+            self._state_cache.save()
+        if self._connected:
+            self._connected = False
+            self._conn.stop()
+
+    def _request(self, group, queue, method, *args): #Выполняет метод клиента сразу или, если передана очередь, откладывает его в неё.
+        #Кэш группы сбрасывается, только когда запись действительно уходит: планирование (и check mode) его не трогает
+        if queue != None:
+            queue.append((method, args))
+            return None
+        self._invalidate_group(group)
+        return self._call(method, *args)
+
+    def _call(self, method, *args, **kwargs): #Все запросы к Telegram идут через планировщик: лимиты, FloodWait, повторы
+        self._connect()
+        return self._scheduler.call(getattr(self._conn, method), method, *args, **kwargs)
+
+    def _iterate(self, method, *args, **kwargs):
+        self._connect()
+        return self._sleep_through_flood_waits(method, self._scheduler.iterate(getattr(self._conn, method), method, *args, **kwargs))
+
+    def _sleep_through_flood_waits(self, method, items):
+        #Пока идет постраничный список, запросы страниц идут через invoke планировщика: FloodWait до max_flood_wait
+        #пережидается внутри страницы и учитывается в счетчиках, а список не начинается заново
+        previous = vars(self._conn).get('invoke')
+        self._conn.invoke = self._scheduler.sleeping_invoke(self._conn.invoke, method)
+        try:
+            yield from items
+        finally:
+            if previous == None:
+                del self._conn.invoke
+            else:
+                self._conn.invoke = previous
+
+    def get_request_stats(self):
+        return self._scheduler.stats()
+
+    def get_load(self): #Для выбора аккаунта в TgControllerPool: меньше - свободнее
+        return self._scheduler.load()
+
+    def reset_request_stats(self):
+        self._scheduler.reset_stats()
+        if self._profiler != None:
+            self._profiler.reset()
+
+    def get_profile(self): #None, если профилирование выключено
+        if self._profiler == None:
+            return None
+        return self._profiler.report()
+
+    def write_profile(self, path, report, extra=None):
+        if self._profiler != None:
+            self._profiler.write(path, report, extra)
+
+    def flush(self): #Сохраняет кэши на диск, не закрывая соединение (для долгоживущего брокера)
+        if self._state_cache != None:
+            self._state_cache.save()
+        if self._connected and self._peer_cache != None:
+            self._conn.loop.run_until_complete(self._conn.storage.save_peers())
+
+    def run_member_operations(self, operations, group=None): #operations: {username: [(method, args), ...]}. Возвращает {username: exception} для упавших
+        if len(operations) == 0:
+            return {}
+        if group != None:
+            self._invalidate_group(group)
+        self._connect()
+        return self._conn.loop.run_until_complete(self._run_member_operations(operations))
+
+    async def _run_member_operations(self, operations): #Пользователи обрабатываются параллельно (не больше self.concurrency), операции одного пользователя - по порядку.
+        #Воркеров ровно concurrency, они берут пользователей из общего итератора: корутины на каждого из тысяч пользователей не создаются
+        pending = iter(operations.items())
+        errors = {}
+
+        async def worker():
+            for username, user_operations in pending:
+                for method, args in user_operations:
+                    try:
+                        await self._scheduler.call_async(getattr(self._conn, method), method, *args)
+                    except Exception as e:
+                        errors[username] = e
+                        break
+
+        await asyncio.gather(*[worker() for _ in range(min(self.concurrency, len(operations)))])
+        return errors
 
     def _get_chat_member(self, group, username):
-        with self._conn:
-            return self._conn.get_chat_member(group, username)
-
-    def _get_default_chat_permissions(self, group):
-        with self._conn:
-            chat = self._conn.get_chat(group.id)
-            return chat.permissions
+        return self._call('get_chat_member', group, username)
 
+    def _full_permissions(self, permissions): #ChatPermissions со всеми полями: None при записи Pyrogram превращает в запрет.
+        #Pyrogram отдает None вместо прав, если в группе ничего не запрещено - так же выглядит и только что созданная группа
+        full = ChatPermissions()
+        for name in _constructor_fields(full):
+            value = None if permissions == None else getattr(permissions, name, None)
+            setattr(full, name, True if value == None else value)
+        return full
 
-    def get_member_obj(self, group, username):
-        old_user = self._get_chat_member(group.id, username)
+    def _get_default_chat_permissions(self, group):
+        if group.chat_permissions == None and not group.exists: #Группа еще только запланирована (check mode)
+            group.chat_permissions = self._full_permissions(None)
+        if group.chat_permissions == None:
+            chat = self._call('get_chat', group.id)
+            group.chat_permissions = self._full_permissions(chat.permissions)
+        return group.chat_permissions
+
+    def _build_member_obj(self, group, raw_member):
         user = TgMember()
-        user.username = old_user.user.username
-        user.is_admin = old_user.status == ChatMemberStatus.ADMINISTRATOR
-        if old_user.permissions == None:
-            user.permissions = self._get_default_chat_permissions(group)
+        user.username = raw_member.user.username
+        user.is_admin = raw_member.status == ChatMemberStatus.ADMINISTRATOR
+        if raw_member.permissions == None:
+            user.permissions = copy.copy(self._get_default_chat_permissions(group))
         else:
-            user.permissions = old_user.permissions
+            user.is_restricted = True
+            user.permissions = raw_member.permissions
         if user.is_admin:
-            user.admin_title = old_user.custom_title
-            user.privileges = old_user.privileges
+            user.admin_title = raw_member.custom_title
+            user.privileges = raw_member.privileges
         else:
             user.privileges = ChatPrivileges(can_manage_chat=True)
         return user
 
+    def get_members_snapshot(self, group, listed=None): #Одним постраничным проходом забирает участников группы в group.members_list {username: TgMember}.
+        #С listed (exclusive) TgMember строится только для перечисленных, остальные в том же проходе попадают в
+        #group.unlisted_members {username или id: user_id}. Себя, другие аккаунты пула и владельца не трогаем
+        if group.members_list == None or (listed != None and group.unlisted_members == None):
+            group.members_list = {}
+            if listed != None:
+                group.unlisted_members = {}
+                listed = set(username.lower() for username in listed)
+            if not group.exists:
+                return group.members_list
+            for raw_member in self._iterate('get_chat_members', group.id):
+                user = raw_member.user
+                username = user.username.lower() if user.username != None else None
+                if listed != None and username not in listed:
+                    if not self._is_pool_account(user) and raw_member.status != ChatMemberStatus.OWNER:
+                        group.unlisted_members[user.username or str(user.id)] = user.id
+                    continue
+                if username == None:
+                    continue
+                group.members_list[username] = self._build_member_obj(group, raw_member)
+        return group.members_list
+
+    def new_member_obj(self, group, username): #Участник, каким он будет сразу после добавления в группу
+        user = TgMember()
+        user.username = username
+        user.is_admin = False
+        user.permissions = copy.copy(self._get_default_chat_permissions(group))
+        user.privileges = ChatPrivileges(can_manage_chat=True)
+        return user
+
+    def get_member_obj(self, group, username):
+        if group.members_list != None and username.lower() in group.members_list:
+            return group.members_list[username.lower()]
+        user = self._build_member_obj(group, self._get_chat_member(group.id, username))
+        if group.members_list != None:
+            group.members_list[username.lower()] = user
+        return user
+
+    def _dump_object(self, object): #ChatPermissions/ChatPrivileges -> dict для кэша. Только параметры конструктора, иначе из кэша объект не собрать
+        if object == None:
+            return None
+        return {key: getattr(object, key, None) for key in _constructor_fields(object) if isinstance(getattr(object, key, None), (bool, type(None)))}
+
+    def _group_to_cache(self, group):
+        members = None
+        if group.members_list != None and group.unlisted_members == None: #Снимок с exclusive неполный - участников не кэшируем
+            members = {}
+            for username, member in group.members_list.items():
+                members[username] = {'username': member.username,
+                                     'is_admin': member.is_admin,
+                                     'is_restricted': member.is_restricted,
+                                     'admin_title': member.admin_title,
+                                     'permissions': self._dump_object(member.permissions),
+                                     'privileges': self._dump_object(member.privileges)}
+        return {'id': group.id,
+                'title': group.title,
+                'description': group.description,
+                'image_hash': group.image_hash,
+                'metadata_message_id': group.metadata_message_id,
+                'metadata_editable': group.metadata_editable,
+                'members_count': group.members_count,
+                'ownership': group.ownership,
+                'chat_permissions': self._dump_object(group.chat_permissions),
+                'members': members}
+
+    def _group_from_cache(self, entry):
+        group = TgGroup()
+        group.id = entry['id']
+        group.title = entry['title']
+        group.description = entry['description']
+        group.image_hash = entry['image_hash']
+        group.metadata_message_id = entry.get('metadata_message_id')
+        group.metadata_editable = entry.get('metadata_editable', True)
+        group.members_count = entry.get('members_count')
+        group.exists = True
+        group.ownership = entry.get('ownership', True) #Раньше кэшировались только свои группы
+        if entry['chat_permissions'] != None:
+            group.chat_permissions = ChatPermissions(**entry['chat_permissions'])
+        if entry['members'] != None:
+            group.members_list = {}
+            for username, cached_member in entry['members'].items():
+                member = TgMember()
+                member.username = cached_member['username']
+                member.is_admin = cached_member['is_admin']
+                member.is_restricted = cached_member.get('is_restricted', False)
+                member.admin_title = cached_member['admin_title']
+                if cached_member['permissions'] != None:
+                    member.permissions = ChatPermissions(**cached_member['permissions'])
+                if cached_member['privileges'] != None:
+                    member.privileges = ChatPrivileges(**cached_member['privileges'])
+                group.members_list[username] = member
+        return group
+
+    def _get_cached_group(self, title, id): #Группа из локального кэша. Если включена перепроверка - один get_chat
+        entry = self._state_cache.get(id=id, title=title)
+        if entry == None:
+            return None
+        try:
+            group = self._group_from_cache(entry)
+        except (TypeError, KeyError, AttributeError): #Запись, которую не собрать (другая версия Pyrogram или модуля) - читаем группу заново
+            self._state_cache.invalidate(entry.get('id', id))
+            return None
+        if self.state_cache_revalidate:
+            try:
+                chat = self._call('get_chat', group.id)
+            except Exception:
+                self._state_cache.invalidate(group.id)
+                return None
+            if not chat.title == group.title or not chat.description == group.description or not chat.members_count == group.members_count:
+                self._state_cache.invalidate(group.id) #Состав мог поменяться без нас - снимок участников устарел
+                return None
+            group.chat_permissions = self._full_permissions(chat.permissions)
+        return group
+
+    def remember_group(self, group): #Сохраняет актуальное состояние группы в кэш после успешной обработки. Только группы, где мы владелец или администратор:
+        #их мы читаем целиком. Прав нет у групп из кэша (туда попадают только такие) и у только что созданных
+        if self._state_cache != None and group.exists and (group.ownership or group.rights == None or group.rights.is_admin):
+            self._state_cache.put(group.id, self._group_to_cache(group))
+
+    def _invalidate_group(self, group):
+        if self._state_cache != None and group.id != None:
+            self._state_cache.invalidate(group.id)
+
     def get_group_obj(self, title, id=None):
+        if self._state_cache != None:
+            group = self._get_cached_group(title, id)
+            if group != None:
+                return group
         group = TgGroup()
         group.id = id
         group.title = title
@@ -71,149 +400,389 @@ class TgGroupController:
         else:
             group.exists = self._check_if_group_exists_by_id(group.id)
         if group.exists:
-            group.ownership = self._check_ownership(group.id)
-            if group.ownership:
+            rights = self.get_self_rights(group)
+            group.ownership = rights.is_owner
+            if rights.is_owner or rights.is_admin:
                 raw_group = self._fetch_group_data(group.id)
                 if group.title == None or not group.title == raw_group.title:
                     group.title = raw_group.title
                 group.description = raw_group.description
-                group.image_hash = self._get_last_image_hash(group.id)
+                group.members_count = raw_group.members_count
+                group.chat_permissions = self._full_permissions(raw_group.permissions) #Права по умолчанию из того же get_chat, без второго запроса
+                metadata = self._read_group_metadata(group, raw_group)
+                if metadata != None:
+                    group.image_hash = metadata.get('image_hash')
+                else:
+                    group.image_hash = self._get_last_image_hash(group.id)
         return group
 
     def create_new_group(self, group): #Получает перечисленные параметры, создает группу.
-        with self._conn:
-            new_group = self._conn.create_supergroup(group.title)
-            group.id = new_group.id
-            group.title = new_group.title
-            group.ownership = True
-            group.exists = True
-            self._conn.send_message(chat_id=group.id, text='group_id:' + str(group.id))
-            return group
+        new_group = self._call('create_supergroup', group.title)
+        group.id = new_group.id
+        group.title = new_group.title
+        group.ownership = True
+        group.exists = True
+        group.chat_permissions = self._full_permissions(new_group.permissions) #Настоящие права новой группы, по ним планируются права по умолчанию и участники
+        self._index_add(new_group)
+        self._save_group_metadata(group)
+        return group
 
-    def _check_if_group_exists_by_title(self, title): #находит в списке чатов группу с таким именем. Возвращает bool
-        with self._conn:
-            for dialog in self._conn.get_dialogs():
-                if (dialog.chat.title == title) and (dialog.chat.type.name == "GROUP" or dialog.chat.type.name == "SUPERGROUP"):
-                    return True
+    def _get_dialog_index(self): #Один проход по get_dialogs(): индексы групп по id и по названию
+        if self._dialogs_by_id == None:
+            self._dialogs_expired = False
+            self._dialogs_by_id = {}
+            self._dialogs_by_title = {}
+            for dialog in self._iterate('get_dialogs'):
+                if dialog.chat.type.name == "GROUP" or dialog.chat.type.name == "SUPERGROUP":
+                    self._dialogs_by_id[dialog.chat.id] = dialog.chat
+                    self._dialogs_by_title.setdefault(dialog.chat.title, []).append(dialog.chat)
+        return self._dialogs_by_id, self._dialogs_by_title
+
+    def expire_dialog_index(self): #Индекс из прошлой задачи (брокер): группы, в которые аккаунт вступил с тех пор, в нем не видны
+        if self._dialogs_by_id != None:
+            self._dialogs_expired = True
+
+    def _refresh_dialog_index(self): #После промаха по устаревшему индексу - один новый проход, иначе create_supergroup создал бы дубликат
+        if not self._dialogs_expired:
             return False
+        self._dialogs_by_id = None
+        self._dialogs_by_title = None
+        self._get_dialog_index()
+        return True
+
+    def _index_add(self, chat): #Обновляет уже построенный индекс вместо повторного прохода по диалогам
+        if self._dialogs_by_id != None:
+            self._dialogs_by_id[chat.id] = chat
+            self._dialogs_by_title.setdefault(chat.title, []).append(chat)
+
+    def _index_remove(self, id):
+        if self._dialogs_by_id != None and id in self._dialogs_by_id:
+            chat = self._dialogs_by_id.pop(id)
+            self._dialogs_by_title[chat.title] = [c for c in self._dialogs_by_title.get(chat.title, []) if c.id != id]
+
+    def _find_chat_by_title(self, title): #Возвращает чат с таким названием или None. Если групп несколько - ValueError
+        by_id, by_title = self._get_dialog_index()
+        chats = by_title.get(title, [])
+        if len(chats) == 0 and self._refresh_dialog_index():
+            chats = self._dialogs_by_title.get(title, [])
+        if len(chats) > 1:
+            raise ValueError("More than one group titled '" + str(title) + "': " + ", ".join(str(chat.id) for chat in chats))
+        if len(chats) == 0:
+            return None
+        return chats[0]
 
-    def _check_if_group_exists_by_id(self, id): #находит в списке чатов группу с таким именем. Возвращает bool
-        with self._conn:
-            for dialog in self._conn.get_dialogs():
-                if (dialog.chat.id == id ) and (dialog.chat.type.name == "GROUP" or dialog.chat.type.name == "SUPERGROUP"):
-                    return True
-            return False
+    def _check_if_group_exists_by_title(self, title): #находит в списке чатов группу с таким именем. Возвращает bool
+        return self._find_chat_by_title(title) != None
+
+    def _check_if_group_exists_by_id(self, id): #находит в списке чатов группу с таким id. Возвращает bool
+        by_id, by_title = self._get_dialog_index()
+        if id not in by_id and self._refresh_dialog_index():
+            return id in self._dialogs_by_id
+        return id in by_id
 
     def _get_id_by_title(self, title):
-        with self._conn:
-            for dialog in self._conn.get_dialogs():
-                if (dialog.chat.title == title ) and (dialog.chat.type.name == "GROUP" or dialog.chat.type.name == "SUPERGROUP"):
-                    return dialog.chat.id
+        chat = self._find_chat_by_title(title)
+        if chat == None:
+            return None
+        return chat.id
+
+    def _fetch_group_data(self, id): #Получает по id группы все данные. Возвращает None, если группы нет
+        if self._check_if_group_exists_by_id(id):
+            return self._call('get_chat', id)
+
+    def get_self_rights(self, group): #Наши права в группе: один get_chat_member для себя, результат хранится в group.rights
+        if group.rights == None:
+            rights = TgRights()
+            if not group.exists: #Группу создадим мы сами
+                raw_member = None
+                rights.is_owner = True
+            else:
+                raw_member = self._call('get_chat_member', group.id, 'me')
+                rights.is_owner = raw_member.status == ChatMemberStatus.OWNER
+                rights.is_admin = raw_member.status == ChatMemberStatus.ADMINISTRATOR
+            for name in ('can_change_info', 'can_restrict_members', 'can_promote_members', 'can_invite_users', 'can_pin_messages'):
+                if rights.is_owner:
+                    setattr(rights, name, True)
+                elif rights.is_admin and raw_member.privileges != None:
+                    setattr(rights, name, getattr(raw_member.privileges, name, False) == True)
+            group.rights = rights
+        return group.rights
+
+    def missing_rights(self, group, names): #Какие из прав names (атрибуты TgRights) у нас в группе отсутствуют
+        rights = self.get_self_rights(group)
+        return [name for name in names if not getattr(rights, name)]
+
+    def _is_pool_account(self, user): #Наш аккаунт или другой аккаунт того же пула
+        return user != None and (user.is_self or user.id in self.pool_user_ids)
+
+    def _parse_group_metadata(self, message): #JSON из сообщения с метаданными, написанного нами или другим аккаунтом пула, иначе None
+        if message == None or message.empty or not self._is_pool_account(message.from_user):
+            return None
+        if message.text == None or not message.text.startswith(METADATA_PREFIX):
+            return None
+        try:
+            return json.loads(message.text[len(METADATA_PREFIX):])
+        except ValueError:
             return None
 
-    def _fetch_group_data(self, id): #Получает по названию группы все данные, и записывает в переменные объекта. Возвращает Null
-        with self._conn:
-            for dialog in self._conn.get_dialogs():
-                if dialog.chat.id == id:
-                     return self._conn.get_chat(id)
-
-    def _check_ownership(self, id): #находит в списке чатов группу с таким именем. Возвращает bool
-        with self._conn:
-            for dialog in self._conn.get_dialogs():
-                if (dialog.chat.id == id) and (dialog.chat.type.name == "GROUP" or dialog.chat.type.name == "SUPERGROUP"):
-                    members = self._conn.get_chat_members(chat_id=dialog.chat.id)
-                    for member in members:
-                        if member.user.is_self == True:
-                            if member.status == ChatMemberStatus.OWNER:
-                               return True
-                    return False
-
-    def _get_last_image_hash(self, id):
-        with self._conn:
-            result = None
-            messages = self._conn.search_messages(chat_id=id, query='image_hash:')
-            for message in messages:
-                try:
-                    if message.from_user.is_self:
-                        result = message.text.split(':')[1]
-                except IndexError as e:
-                    pass
-                break
-            return result
+    def _read_group_metadata(self, group, chat): #Метаданные модуля - наше сообщение с JSON. Обычно оно закреплено и приходит в уже полученном get_chat
+        message = chat.pinned_message
+        metadata = self._parse_group_metadata(message)
+        if metadata == None: #Закреп сменил администратор - берем сообщение по запомненному id, а без него ищем последнее наше
+            message_id = None
+            if self._state_cache != None:
+                message_id = self._state_cache.get_metadata_message_id(group.id)
+            if message_id != None:
+                message = self._call('get_messages', group.id, message_id)
+                metadata = self._parse_group_metadata(message)
+            if metadata == None and len(self.pool_user_ids) == 0:
+                for message in self._iterate('search_messages', chat_id=group.id, query=METADATA_PREFIX, limit=1, from_user='me'):
+                    metadata = self._parse_group_metadata(message)
+                    break
+            elif metadata == None: #В пуле автор - любой из аккаунтов: ищем без from_user, до первого сообщения от аккаунта пула
+                for message in self._iterate('search_messages', chat_id=group.id, query=METADATA_PREFIX):
+                    metadata = self._parse_group_metadata(message)
+                    if metadata != None:
+                        break
+        if metadata == None:
+            return None
+        self._remember_metadata_message(group, message.id, message.from_user.is_self)
+        return metadata
+
+    def _remember_metadata_message(self, group, message_id, editable=True):
+        group.metadata_message_id = message_id
+        group.metadata_editable = editable
+        if self._state_cache != None:
+            self._state_cache.put_metadata_message_id(group.id, message_id)
+
+    def _save_group_metadata(self, group, pin=True): #Правит сообщение с метаданными на месте. Новое отправляется и закрепляется, только если своего еще нет
+        #(нет вовсе или его написал другой аккаунт пула), чужой закреп не трогаем
+        text = METADATA_PREFIX + json.dumps({'group_id': group.id, 'image_hash': group.image_hash}, separators=(',', ':'))
+        if group.metadata_message_id != None and group.metadata_editable:
+            self._call('edit_message_text', chat_id=group.id, message_id=group.metadata_message_id, text=text)
+        else:
+            message = self._call('send_message', chat_id=group.id, text=text)
+            if pin:
+                self._call('pin_chat_message', chat_id=group.id, message_id=message.id, disable_notification=True)
+            self._remember_metadata_message(group, message.id)
+
+    def add_group_metadata(self, group): #Один раз пишет метаданные группе, где их нет (старый формат 'image_hash:' или группа создана не модулем).
+        #Закрепляет, только если есть право: незакрепленное сообщение найдется по id или поиском
+        self._invalidate_group(group)
+        self._save_group_metadata(group, pin=self.get_self_rights(group).can_pin_messages)
+
+    def _get_last_image_hash(self, id): #Старый формат: сообщения 'image_hash:'. Только для групп без сообщения с метаданными
+        result = None
+        messages = self._iterate('search_messages', chat_id=id, query='image_hash:')
+        for message in messages:
+            try:
+                if self._is_pool_account(message.from_user):
+                    result = message.text.split(':')[1]
+            except IndexError as e:
+                pass
+            break
+        return result
 
 
     def remove_group(self, group): #Удаляет группу
-        with self._conn:
-            return self._conn.delete_supergroup(group.id)
+        self._invalidate_group(group)
+        result = self._call('delete_supergroup', group.id)
+        self._index_remove(group.id)
+        return result
 
     def set_group_description(self, group): #Задает группе описание. 
+        self._invalidate_group(group)
         if len(group.description) > 255:
             raise ValueError("Description longer than 255 symbols!")
-        with self._conn:
-            self._conn.set_chat_description(chat_id=group.id, description=group.description)
+        self._call('set_chat_description', chat_id=group.id, description=group.description)
 
     def open_image_file(self, path_to_image:str):
         image = open(path_to_image, "rb")
         return image
 
-    def get_image_hash(self, image):
-        image_hash = hashlib.md5(image.read()).hexdigest()
-        return image_hash
+    def get_image_hash(self, image): #Считает md5 кусками по IMAGE_CHUNK_SIZE и возвращает файл в начало
+        image_hash = hashlib.md5()
+        for chunk in iter(lambda: image.read(IMAGE_CHUNK_SIZE), b''):
+            image_hash.update(chunk)
+        image.seek(0)
+        return image_hash.hexdigest()
+
+    def get_file_hash(self, path_to_image:str): #md5 файла с кэшем по (путь, mtime, размер). Неизмененный файл повторно не читается
+        path_to_image = os.path.abspath(path_to_image)
+        stat = os.stat(path_to_image)
+        key = path_to_image + ':' + str(stat.st_mtime_ns) + ':' + str(stat.st_size)
+        hash_cache = self._load_image_hash_cache()
+        if key not in hash_cache:
+            with self.open_image_file(path_to_image) as image:
+                image_hash = self.get_image_hash(image)
+            for old_key in [k for k in hash_cache if k.rsplit(':', 2)[0] == path_to_image]:
+                del hash_cache[old_key]
+            hash_cache[key] = image_hash
+            self._save_image_hash_cache()
+        return hash_cache[key]
+
+    def _load_image_hash_cache(self):
+        if self._image_hashes == None:
+            self._image_hashes = {}
+            if self.image_hash_cache != None and os.path.exists(self.image_hash_cache):
+                try:
+                    with open(self.image_hash_cache) as cache_file:
+                        self._image_hashes = json.load(cache_file)
+                except ValueError:
+                    pass
+        return self._image_hashes
 
-    def close_image(self, image):
-        image.close()
+    def _save_image_hash_cache(self):
+        if self.image_hash_cache != None:
+            cache_dir = os.path.dirname(self.image_hash_cache)
+            if cache_dir != '':
+                os.makedirs(cache_dir, exist_ok=True)
+            with open(self.image_hash_cache, 'w') as cache_file:
+                json.dump(self._image_hashes, cache_file)
 
     def check_membership(self, group, username):
+        if group.members_list != None:
+            return username.lower() in group.members_list
         result = False
-        with self._conn:
-            members = self._conn.get_chat_members(group.id, username)
-            for member in members:
-                if member.user.username == username:
-                    result = True
+        members = self._iterate('get_chat_members', group.id, username)
+        for member in members:
+            if member.user.username == username:
+                result = True
         return result
 
-    def set_new_group_image(self, group): #Задает группе изображение
-        with self._conn:
-            self._conn.set_chat_photo(chat_id=group.id, photo=group.image)
-            self._conn.send_message(chat_id=group.id, text="image_hash:" + group.image_hash)
+    def set_new_group_image(self, group): #Задает группе изображение. group.image - путь к файлу или открытый файл
+        self._invalidate_group(group)
+        if hasattr(group.image, 'seek'):
+            group.image.seek(0)
+        if self._profiler != None:
+            if hasattr(group.image, 'seek'):
+                group.image.seek(0, os.SEEK_END)
+                self._profiler.bytes_uploaded += group.image.tell()
+                group.image.seek(0)
+            else:
+                self._profiler.bytes_uploaded += os.path.getsize(group.image)
+        self._call('set_chat_photo', chat_id=group.id, photo=group.image)
+        self._save_group_metadata(group)
 
     def set_new_title(self, group):
-        with self._conn:
-            self._conn.set_chat_title(chat_id=group.id, title=group.title)
-
-    def add_new_member(self, group, username):
-        with self._conn:
-            self._conn.unban_chat_member(group.id, username)
-            self._conn.add_chat_members(group.id, username)
-
-    def delete_member(self, group, username):
-        with self._conn:
-            self._conn.ban_chat_member(group.id, username)
+        self._invalidate_group(group)
+        self._call('set_chat_title', chat_id=group.id, title=group.title)
+        if self._dialogs_by_id != None and group.id in self._dialogs_by_id:
+            chat = self._dialogs_by_id[group.id]
+            self._index_remove(group.id)
+            chat.title = group.title
+            self._index_add(chat)
+
+    def expect_new_member(self, group, username): #Кладет в снимок участника, которого добавит add_new_members
+        if group.members_list != None:
+            group.members_list[username.lower()] = self.new_member_obj(group, username)
+
+    def get_banned_usernames(self, group):
+        banned = set()
+        for raw_member in self._iterate('get_chat_members', group.id, filter=ChatMembersFilter.BANNED):
+            if raw_member.user.username != None:
+                banned.add(raw_member.user.username.lower())
+        return banned
+
+    def add_new_members(self, group, usernames): #Разбанивает только забаненных и добавляет пачками. Возвращает {username: exception}
+        if len(usernames) == 0:
+            return {}
+        self._invalidate_group(group)
+        group.members_count = None #Число участников после записи не знаем - при следующей перепроверке группа прочитается заново
+        banned = self.get_banned_usernames(group)
+        errors = self.run_member_operations({username: [('unban_chat_member', (group.id, username))] for username in usernames if username.lower() in banned})
+        usernames = [username for username in usernames if username not in errors]
+        for start in range(0, len(usernames), ADD_MEMBERS_CHUNK_SIZE):
+            chunk = usernames[start:start + ADD_MEMBERS_CHUNK_SIZE]
+            try:
+                self._call('add_chat_members', group.id, chunk)
+            except Exception as e:
+                if len(chunk) == 1:
+                    errors[chunk[0]] = e
+                    continue
+                for username in chunk: #Пачка упала целиком - выясняем, кто именно не добавляется
+                    try:
+                        self._call('add_chat_members', group.id, username)
+                    except Exception as e:
+                        errors[username] = e
+        return errors
+
+    def delete_member(self, group, username, queue=None):
+        self._request(group, queue, 'ban_chat_member', group.id, username)
+        group.members_count = None
+        if group.members_list != None:
+            group.members_list.pop(username.lower(), None)
+
+    def get_unlisted_members(self, group, usernames): #{username или id: user_id} тех, кого нет в usernames. Из того же прохода, что и снимок участников
+        self.get_members_snapshot(group, usernames)
+        return group.unlisted_members
+
+    def delete_members(self, group, members): #members: {имя: user_id}. Баны идут параллельно через планировщик. Возвращает {имя: exception}
+        if len(members) == 0:
+            return {}
+        self._invalidate_group(group)
+        group.members_count = None
+        errors = self.run_member_operations({name: [('ban_chat_member', (group.id, user_id))] for name, user_id in members.items()})
+        if group.members_list != None:
+            for name in members:
+                if name not in errors:
+                    group.members_list.pop(name.lower(), None)
+        return errors
+
+    def diff_object(self, array, object): #Возвращает только те заданные (не None) поля, которые отличаются от текущих. Ключи - имена полей Pyrogram
+        diff = {}
+        for key in array.keys():
+            field = FIELD_ALIASES.get(key, key)
+            if not hasattr(object, field):
+                raise ValueError("Unknown field '" + key + "' for " + type(object).__name__)
+            if array[key] != None and not getattr(object, field) == array[key]:
+                diff[field] = array[key]
+        return diff
 
     def list_object_merge(self, array, object):
         for key in array.keys():
             setattr(object, key, array[key])
         return object
 
-    def push_permissions(self, group, username, permissions):
-        with self._conn:
-            self._conn.restrict_chat_member(group.id, username, permissions)
+    def push_permissions(self, group, username, permissions, queue=None):
+        self._request(group, queue, 'restrict_chat_member', group.id, username, permissions)
+        if group.members_list != None and username.lower() in group.members_list:
+            group.members_list[username.lower()].is_restricted = True
+
+    def get_default_permissions(self, group):
+        return self._get_default_chat_permissions(group)
+
+    def inherit_default_permissions(self, group): #Неограниченные участники получают права группы по умолчанию - обновляем снимок
+        if group.members_list != None:
+            for member in group.members_list.values():
+                if not member.is_restricted and not member.is_admin:
+                    member.permissions = copy.copy(group.chat_permissions)
+
+    def most_common_permissions(self, permission_sets): #Набор прав, который задан больше чем у половины пользователей (и минимум у двух), иначе None
+        counts = {}
+        for permissions in permission_sets:
+            key = tuple(sorted((name, value) for name, value in permissions.items() if value != None))
+            if len(key) > 0:
+                counts[key] = counts.get(key, 0) + 1
+        if len(counts) == 0:
+            return None
+        key, count = max(counts.items(), key=lambda item: item[1])
+        if count < 2 or count * 2 <= len(permission_sets):
+            return None
+        return dict(key)
 
-    def push_privileges(self, group, username, privileges):
-        with self._conn:
-            self._conn.promote_chat_member(group.id, username, privileges)
+    def push_privileges(self, group, username, privileges, queue=None):
+        self._request(group, queue, 'promote_chat_member', group.id, username, privileges)
 
-    def remove_privileges(self, group, username):
-        with self._conn:
-            self._conn.promote_chat_member(group.id, username, ChatPrivileges(can_manage_chat=False, can_delete_messages=False, can_change_info=False, can_invite_users=False, can_edit_messages=False, can_manage_video_chats=False, can_post_messages=False, can_promote_members=False, can_restrict_members=False, is_anonymous=False))
+    def remove_privileges(self, group, username, queue=None):
+        self._request(group, queue, 'promote_chat_member', group.id, username, ChatPrivileges(can_manage_chat=False, can_delete_messages=False, can_change_info=False, can_invite_users=False, can_edit_messages=False, can_manage_video_chats=False, can_post_messages=False, can_promote_members=False, can_restrict_members=False, is_anonymous=False))
 
-    def set_admin_title(self, group, username, title):
-        with self._conn:
-            self._conn.set_administrator_title(group.id, username, title)
+    def set_admin_title(self, group, username, title, queue=None):
+        self._request(group, queue, 'set_administrator_title', group.id, username, title)
 
     def push_default_permissions(self, group, permissions):
-        with self._conn:
-            self._conn.set_chat_permissions(group.id, permissions)
+        self._invalidate_group(group)
+        self._call('set_chat_permissions', group.id, permissions)
 
 
 
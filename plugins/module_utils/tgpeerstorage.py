@@ -0,0 +1,83 @@
+from pyrogram.storage import MemoryStorage
+import os
+import sqlite3
+
+PEER_TABLES = ('peers',) #Только кэш пиров (в Pyrogram 2.0 username хранится в peers). Ключ авторизации на диск не пишем - он остается в session_string
+
+
+class TgPeerStorage(MemoryStorage):
+    #Сессия из session_string в памяти, а username -> id/access_hash переживает запуски в отдельном SQLite-файле
+    def __init__(self, name, session_string, path, username_ttl=None):
+        super().__init__(name, session_string)
+        self.path = path
+        if username_ttl != None:
+            self.USERNAME_TTL = username_ttl #Pyrogram не верит username старше 8 часов и снова делает ResolveUsername. Больший TTL - явный выбор: за это время username могут передать другому
+
+    async def open(self):
+        await super().open()
+        if not os.path.exists(self.path):
+            return
+        try:
+            peer_file = sqlite3.connect(self.path)
+            try:
+                owner = peer_file.execute("SELECT user_id FROM owner").fetchone()
+                if owner == None or owner[0] != await self.user_id():
+                    return
+                for table in PEER_TABLES:
+                    self._copy_rows(peer_file, self.conn, table)
+            finally:
+                peer_file.close()
+        except sqlite3.Error:
+            pass #Битый или чужой файл - просто начинаем с пустого кэша
+
+    async def save_peers(self):
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir != '':
+            os.makedirs(cache_dir, exist_ok=True)
+        peer_file = sqlite3.connect(self.path)
+        try:
+            peer_file.execute("DROP TABLE IF EXISTS owner")
+            peer_file.execute("CREATE TABLE owner (user_id INTEGER)")
+            peer_file.execute("INSERT INTO owner VALUES (?)", (await self.user_id(),))
+            for table in PEER_TABLES:
+                schema = self.conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+                if schema == None:
+                    continue
+                peer_file.execute("DROP TABLE IF EXISTS " + table)
+                peer_file.execute(schema[0])
+                self._copy_rows(self.conn, peer_file, table)
+            peer_file.commit()
+        finally:
+            peer_file.close()
+
+    async def close(self):
+        try:
+            await self.save_peers()
+        except sqlite3.Error:
+            pass
+        await super().close()
+
+    def forget_usernames(self, usernames): #Удаляет устаревшие записи. Возвращает True, если что-то было удалено
+        removed = 0
+        for username in usernames:
+            username = username.lstrip('@').lower()
+            for table in PEER_TABLES:
+                try:
+                    removed += self.conn.execute("DELETE FROM " + table + " WHERE username = ?", (username,)).rowcount
+                except sqlite3.Error:
+                    pass
+        return removed > 0
+
+    def _copy_rows(self, source, target, table):
+        try:
+            cursor = source.execute("SELECT * FROM " + table)
+        except sqlite3.Error:
+            return
+        source_columns = [column[0] for column in cursor.description]
+        target_columns = [row[1] for row in target.execute("PRAGMA table_info(" + table + ")")]
+        columns = [column for column in source_columns if column in target_columns]
+        if len(columns) == 0:
+            return
+        indexes = [source_columns.index(column) for column in columns]
+        target.executemany("INSERT OR REPLACE INTO " + table + " (" + ", ".join(columns) + ") VALUES (" + ", ".join("?" * len(columns)) + ")",
+                           [[row[index] for index in indexes] for row in cursor])
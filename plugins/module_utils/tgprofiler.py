@@ -0,0 +1,55 @@
+import functools
+import json
+import os
+import time
+
+
+class TgProfiler:
+    #Счетчики и время вызовов: методы контроллера ('controller.*') и запросы к Telegram ('rpc.*')
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._timings = {}
+        self.bytes_uploaded = 0
+        self.connections = 0
+        self.connect_seconds = 0.0
+        self.flood_wait_sleeps = 0
+        self.flood_wait_seconds = 0.0
+        self.throttle_seconds = 0.0
+
+    def record(self, name, seconds):
+        self._timings.setdefault(name, []).append(seconds)
+
+    def wrap(self, name, function): #Обертка, замеряющая каждый вызов function
+        @functools.wraps(function)
+        def profiled(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, time.perf_counter() - started)
+        return profiled
+
+    def report(self):
+        methods = {}
+        for name, timings in sorted(self._timings.items()):
+            ordered = sorted(timings)
+            methods[name] = {'calls': len(ordered),
+                             'total': round(sum(ordered), 6),
+                             'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 6)}
+        return {'methods': methods,
+                'bytes_uploaded': self.bytes_uploaded,
+                'connections': self.connections,
+                'connect_seconds': round(self.connect_seconds, 6),
+                'flood_wait_sleeps': self.flood_wait_sleeps,
+                'flood_wait_seconds': round(self.flood_wait_seconds, 3),
+                'throttle_seconds': round(self.throttle_seconds, 3)}
+
+    def write(self, path, report, extra=None): #Дописывает отчет строкой JSON, чтобы сравнивать запуски между собой
+        directory = os.path.dirname(path)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+        line = dict(extra or {}, time=time.time(), profile=report)
+        with open(path, 'a') as profile_file:
+            profile_file.write(json.dumps(line) + '\n')
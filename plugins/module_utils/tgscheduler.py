@@ -0,0 +1,250 @@
+import asyncio
+import math
+import time
+
+#Классы методов клиента, у каждого класса свой лимит запросов
+WRITE_METHODS = ('add_chat_members', 'ban_chat_member', 'unban_chat_member', 'restrict_chat_member', 'promote_chat_member',
+                 'set_administrator_title', 'set_chat_permissions', 'set_chat_title', 'set_chat_description',
+                 'send_message', 'edit_message_text', 'pin_chat_message', 'create_supergroup', 'delete_supergroup')
+UPLOAD_METHODS = ('set_chat_photo',)
+#Повтор после сетевой ошибки может выполнить запрос дважды (вторая группа, второе сообщение), такие не повторяем
+NON_IDEMPOTENT_METHODS = ('create_supergroup', 'send_message', 'add_chat_members', 'set_chat_photo')
+PAGE_SIZES = {'get_dialogs': 100, 'get_chat_members': 200, 'search_messages': 100} #Сколько элементов Pyrogram получает одним запросом
+
+DEFAULT_RATES = {'read': (20, 20),   #(запросов в секунду, размер пачки)
+                 'write': (5, 5),
+                 'upload': (1, 1)}
+
+#Заполняются в _load_errors: pyrogram.errors тянет за собой весь Pyrogram
+FloodWait = None
+TRANSIENT_ERRORS = None
+STALE_PEER_ERRORS = None
+
+
+def _load_errors():
+    global FloodWait, TRANSIENT_ERRORS, STALE_PEER_ERRORS
+    if FloodWait == None:
+        from pyrogram.errors import FloodWait
+        from pyrogram.errors import InternalServerError
+        from pyrogram.errors import PeerIdInvalid
+        from pyrogram.errors import UsernameInvalid
+        from pyrogram.errors import UsernameNotOccupied
+        from pyrogram.errors import UserIdInvalid
+        TRANSIENT_ERRORS = (InternalServerError, ConnectionError, TimeoutError, asyncio.TimeoutError, OSError)
+        STALE_PEER_ERRORS = (PeerIdInvalid, UsernameInvalid, UsernameNotOccupied, UserIdInvalid)
+
+
+def _string_arguments(args, kwargs): #Строковые аргументы вызова - кандидаты в username
+    strings = []
+    for value in list(args) + list(kwargs.values()):
+        if isinstance(value, str):
+            strings.append(value)
+        elif isinstance(value, (list, tuple)):
+            strings.extend(item for item in value if isinstance(item, str))
+    return strings
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def reserve(self): #Забирает токен. Возвращает, сколько секунд надо подождать перед запросом
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = 0
+        if self.tokens < 0:
+            wait = -self.tokens / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def delay(self): #Сколько ждал бы запрос прямо сейчас, токен не забирается
+        now = time.monotonic()
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        return max(0, (1 - tokens) / self.rate, self.blocked_until - now)
+
+    def block(self, seconds): #После FloodWait весь класс методов ждет, а не только упавший запрос
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class TgRequestScheduler:
+    def __init__(self, rates=None, max_retries=5, max_flood_wait=300, forget_peers=None, profiler=None):
+        _load_errors()
+        self.max_retries = max_retries
+        self.profiler = profiler
+        self.forget_peers = forget_peers #Колбэк: удалить из кэша пиров устаревшие username. True - было что удалять, стоит повторить
+        self.max_flood_wait = max_flood_wait
+        self._buckets = {}
+        for method_class, (rate, burst) in dict(DEFAULT_RATES, **(rates or {})).items():
+            self._buckets[method_class] = TokenBucket(rate, burst)
+        self.retries = 0
+        self.flood_waits = 0
+        self.long_flood_waits = 0
+        self.wait_seconds = 0.0
+        self.requests = 0
+        self.unavailable_until = 0 #До этого момента (time.monotonic) аккаунт под FloodWait длиннее max_flood_wait
+
+    def _method_class(self, method):
+        if method in UPLOAD_METHODS:
+            return 'upload'
+        if method in WRITE_METHODS:
+            return 'write'
+        return 'read'
+
+    def _retry_delay(self, method, error, attempt, args=(), kwargs={}): #Сколько ждать перед повтором. None - не повторять
+        if attempt >= self.max_retries:
+            return None
+        if isinstance(error, STALE_PEER_ERRORS):
+            if self.forget_peers != None and self.forget_peers(_string_arguments(args, kwargs)):
+                return 0
+            return None
+        if isinstance(error, FloodWait):
+            if error.value > self.max_flood_wait:
+                self.long_flood_waits += 1
+                self.unavailable_until = max(self.unavailable_until, time.monotonic() + error.value)
+                return None
+            self.flood_waits += 1
+            if self.profiler != None:
+                self.profiler.flood_wait_sleeps += 1
+                self.profiler.flood_wait_seconds += error.value
+            self._buckets[self._method_class(method)].block(error.value)
+            return error.value
+        if isinstance(error, TRANSIENT_ERRORS) and method not in NON_IDEMPOTENT_METHODS:
+            return min(2 ** attempt, 30)
+        return None
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            self.wait_seconds += seconds
+            time.sleep(seconds)
+
+    async def _sleep_async(self, seconds):
+        if seconds > 0:
+            self.wait_seconds += seconds
+            await asyncio.sleep(seconds)
+
+    def _check_available(self): #Пока аккаунт под долгим FloodWait, запрос не отправляется - сразу та же ошибка (и в счетчик)
+        remaining = self.unavailable_until - time.monotonic()
+        if remaining > 0:
+            self.long_flood_waits += 1
+            raise FloodWait(value=int(math.ceil(remaining)))
+
+    def _throttle(self, method): #Ожидание токена. Отдельно учитывается профилировщиком
+        self.requests += 1
+        delay = self._buckets[self._method_class(method)].reserve()
+        if self.profiler != None and delay > 0:
+            self.profiler.throttle_seconds += delay
+        return delay
+
+    def _record(self, method, started):
+        if self.profiler != None:
+            self.profiler.record('rpc.' + method, time.perf_counter() - started)
+
+    def call(self, function, method, *args, **kwargs):
+        attempt = 0
+        while True:
+            self._check_available()
+            self._sleep(self._throttle(method))
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(method, e, attempt, args, kwargs)
+                if delay == None:
+                    raise
+                attempt += 1
+                self.retries += 1
+                self._sleep(delay)
+            finally:
+                self._record(method, started)
+
+    async def call_async(self, function, method, *args, **kwargs):
+        attempt = 0
+        while True:
+            self._check_available()
+            await self._sleep_async(self._throttle(method))
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(method, e, attempt, args, kwargs)
+                if delay == None:
+                    raise
+                attempt += 1
+                self.retries += 1
+                await self._sleep_async(delay)
+            finally:
+                self._record(method, started)
+
+    def iterate(self, function, method, *args, **kwargs):
+        #Для постраничных методов: токен на каждую страницу. После FloodWait или сбоя посреди списка
+        #запрос выполняется заново (смещения в Pyrogram нет), уже отданные элементы пропускаются
+        attempt = 0
+        yielded = 0
+        progress = 0
+        page_size = PAGE_SIZES.get(method, 100)
+        while True:
+            self._check_available()
+            spent = 0.0 #Время только внутри запросов, без обработки элементов вызывающим кодом
+            position = 0
+            try:
+                items = iter(function(*args, **kwargs))
+                while True:
+                    if position % page_size == 0:
+                        self._sleep(self._throttle(method))
+                    step_started = time.perf_counter()
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                    finally:
+                        spent += time.perf_counter() - step_started
+                    position += 1
+                    if position > yielded:
+                        yielded = position
+                        yield item
+            except Exception as e:
+                if yielded > progress: #Счетчик попыток - только для сбоев подряд без продвижения
+                    progress = yielded
+                    attempt = 0
+                delay = self._retry_delay(method, e, attempt, args, kwargs)
+                if delay == None:
+                    raise
+                attempt += 1
+                self.retries += 1
+                self._sleep(delay)
+            finally:
+                if self.profiler != None:
+                    self.profiler.record('rpc.' + method, spent)
+
+    def sleeping_invoke(self, invoke, method): #Client.invoke для страниц постраничного метода. Генератор Pyrogram после исключения
+        #не продолжить, поэтому FloodWait до max_flood_wait пережидается прямо внутри страницы - с учетом в счетчиках
+        async def invoke_through_flood_waits(*args, **kwargs):
+            while True:
+                try:
+                    return await invoke(*args, **kwargs)
+                except FloodWait as e:
+                    if e.value > self.max_flood_wait:
+                        raise
+                    self.retries += 1
+                    await self._sleep_async(self._retry_delay(method, e, 0))
+        return invoke_through_flood_waits
+
+    def load(self): #Насколько занят аккаунт: (секунд до конца долгого FloodWait, секунд до свободного токена на запись, запросов сделано)
+        return (max(0, self.unavailable_until - time.monotonic()), self._buckets['write'].delay(), self.requests)
+
+    def reset_stats(self):
+        self.retries = 0
+        self.flood_waits = 0
+        self.long_flood_waits = 0
+        self.wait_seconds = 0.0
+
+    def stats(self):
+        return {'retries': self.retries,
+                'flood_waits': self.flood_waits,
+                'long_flood_waits': self.long_flood_waits,
+                'wait_seconds': round(self.wait_seconds, 3)}
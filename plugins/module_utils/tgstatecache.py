@@ -0,0 +1,76 @@
+import json
+import os
+import time
+
+
+class TgStateCache:
+    #Локальный JSON-кэш состояния групп: {'groups': {id: запись}, 'titles': {название: id}, 'metadata': {id: id сообщения с метаданными}}
+    def __init__(self, path, ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self._data = None
+        self._dirty = False
+
+    def _load(self):
+        if self._data == None:
+            self._data = {'groups': {}, 'titles': {}}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path) as cache_file:
+                        data = json.load(cache_file)
+                    if isinstance(data, dict) and 'groups' in data and 'titles' in data:
+                        self._data = data
+                except ValueError:
+                    pass
+        return self._data
+
+    def get(self, id=None, title=None): #Возвращает свежую запись по id или по названию, иначе None
+        data = self._load()
+        if id == None:
+            id = data['titles'].get(title)
+            if id == None:
+                return None
+        entry = data['groups'].get(str(id))
+        if entry == None:
+            return None
+        if time.time() - entry['updated'] > self.ttl:
+            self.invalidate(id)
+            return None
+        return entry
+
+    def put(self, id, entry):
+        data = self._load()
+        self.invalidate(id)
+        entry['updated'] = time.time()
+        data['groups'][str(id)] = entry
+        data['titles'][entry['title']] = id
+        self._dirty = True
+
+    def invalidate(self, id): #Вызывается при каждой нашей записи в группу
+        data = self._load()
+        entry = data['groups'].pop(str(id), None)
+        if entry != None:
+            if data['titles'].get(entry['title']) == id:
+                del data['titles'][entry['title']]
+            self._dirty = True
+
+    def get_metadata_message_id(self, id): #id сообщения с метаданными живет дольше записи о группе: invalidate и ttl его не сбрасывают
+        return self._load().get('metadata', {}).get(str(id))
+
+    def put_metadata_message_id(self, id, message_id):
+        metadata = self._load().setdefault('metadata', {})
+        if metadata.get(str(id)) != message_id:
+            metadata[str(id)] = message_id
+            self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir != '':
+            os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(self._data, cache_file)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
@@ -113,6 +113,85 @@ EXAMPLES = r'''
             can_invite_users: True
             can_pin_messages: True
             is_anonymous: True
+
+# nightly convergence run that trusts a local state cache for a day
+  - name: converge groups from cache
+    avant_it.telegram.group_keeper:
+      session_string: <session_string>
+      state_cache: ~/.cache/telegram_groups.json
+      state_cache_ttl: 86400
+      group_title: Test group
+      users:
+      - name: telegram_username_of_user
+
+# group default permissions
+  - name: group default permissions
+    avant_it.telegram.group_keeper:
+      session_string: <session_string>
+      group_title: Test group
+      default_group_permissions:
+        can_send_polls: False
+
+# same permissions for most users: set them once as group defaults, restrict only the rest
+  - name: optimized permissions
+    avant_it.telegram.group_keeper:
+      session_string: <session_string>
+      group_title: Test group
+      optimize_permissions: True
+      users:
+      - name: first_user
+        permissions:
+          can_pin_messages: False
+      - name: second_user
+        permissions:
+          can_pin_messages: False
+      - name: third_user
+        permissions:
+          can_pin_messages: True
+
+# exact roster: everyone who is not listed in users is removed from the group
+  - name: exclusive membership
+    avant_it.telegram.group_keeper:
+      session_string: <session_string>
+      group_title: Test group
+      exclusive: True
+      users:
+      - name: first_user
+      - name: second_user
+
+# spread groups over several admin accounts
+  - name: groups through an account pool
+    avant_it.telegram.group_keeper:
+      session_strings:
+      - <first_session_string>
+      - <second_session_string>
+      groups:
+      - group_title: Test group 1
+      - group_title: Test group 2
+
+# keep one authenticated client warm for all tasks of the play (single session_string only, not with session_strings)
+  - name: group through the local broker
+    avant_it.telegram.group_keeper:
+      session_string: <session_string>
+      broker: True
+      broker_idle_timeout: 600
+      group_title: Test group
+      users:
+      - name: telegram_username_of_user
+
+# reconcile several groups over one connection
+  - name: many groups in one task
+    avant_it.telegram.group_keeper:
+      session_string: <session_string>
+      groups:
+      - group_title: Test group 1
+        users:
+        - name: telegram_username_of_user
+      - group_title: Test group 2
+        group_description: Second group
+        users:
+        - name: telegram_username_of_user
+          state: absent
 '''
 
 RETURN = r'''
@@ -123,23 +202,357 @@ original_message:
     returned: always
     sample: 'hello world'
 message:
-    description: The output message that the test module generates.
-    type: str
+    description: The output message that the test module generates. With C(groups) it is a list with one change summary per group, each carrying the C(group) title. A group that failed has C(failed) and C(msg), the other groups are still processed. In check mode the change list is the plan that would be applied.
+    type: raw
     returned: always
     sample: 'goodbye'
+diff:
+    description: Group state before and after the planned changes, one entry per group.
+    type: list
+    returned: when diff mode is on
+profile:
+    description: Per-method call counts, total and p95 latency in seconds for controller methods (controller.*) and Telegram requests (rpc.*), plus uploaded bytes, connection setups and FloodWait/throttle sleeps. With C(session_strings) one such report per account under C(accounts).
+    type: dict
+    returned: when profile is true
+crypto_backend:
+    description: Encryption backend of Pyrogram - C(tgcrypto), or C(python) when TgCrypto is missing and everything is much slower.
+    type: str
+    returned: always
+    sample: 'tgcrypto'
+request_stats:
+    description: Counters of the request scheduler - retried requests, FloodWait errors (long ones, over C(max_flood_wait), separately) and total seconds spent waiting. With C(session_strings) the sums over all accounts plus the number of accounts and of groups moved to another account after a long FloodWait.
+    type: dict
+    returned: when connected
+    sample: {'retries': 2, 'flood_waits': 1, 'long_flood_waits': 0, 'wait_seconds': 14.2}
 '''
+import math
+
 from ansible.module_utils.basic import AnsibleModule
 from ansible_collections.avant_it.telegram.plugins.module_utils.tggroupcontroller import TgGroupController
+from ansible_collections.avant_it.telegram.plugins.module_utils.tggroupcontroller import crypto_backend
+from ansible_collections.avant_it.telegram.plugins.module_utils.tgbroker import call_broker
+from ansible_collections.avant_it.telegram.plugins.module_utils.tgcontrollerpool import TgControllerPool
 
-def run_module():
-    module_args = dict(
-        group_title=dict(type='str', required=True),
-        session_string=dict(type='str', required=True),
+
+class GroupKeeperError(Exception):
+    pass
+
+
+#Какие наши права (атрибуты TgRights) нужны для каждого вида изменений из change list.
+#Картинка и создание группы закрепляют сообщение с метаданными
+REQUIRED_RIGHTS = {'Group removed': ('is_owner',),
+                   'Group Created': ('can_pin_messages',),
+                   'Group Title': ('can_change_info',),
+                   'Group Description': ('can_change_info',),
+                   'Group Image': ('can_change_info', 'can_pin_messages'),
+                   'Group Permissions': ('can_restrict_members',),
+                   'User added': ('can_invite_users',),
+                   'User removed': ('can_restrict_members',),
+                   'User permissions': ('can_restrict_members',),
+                   'User privileges': ('can_promote_members',),
+                   'User privileges removed': ('can_promote_members',),
+                   'User admin title': ('can_promote_members',)}
+
+
+def reconcile(tg_controller, module_params, check_mode=False, diff_mode=False): #Возвращает (failed, msg, result)
+    result = dict(
+        changed=False,
+        original_message='',
+        message=''
+    )
+    group_results = []
+    diffs = []
+
+    def collect_request_stats():
+        result['request_stats'] = tg_controller.get_request_stats()
+        profile = tg_controller.get_profile()
+        if profile != None:
+            if module_params['profile']:
+                result['profile'] = profile
+            if module_params['profile_file'] != None:
+                titles = [group['group_title'] for group in module_params['groups'] or [module_params]]
+                tg_controller.write_profile(module_params['profile_file'], profile, {'groups': titles, 'check_mode': check_mode})
+
+    def new_changes(title):
+        changes = {"changed" : False,
+                   "count" : 0,
+                   "change list" : []
+                   }
+        if module_params['groups'] != None:
+            changes['group'] = title
+        group_results.append(changes)
+        return changes
+
+    def finish_changes(changes):
+        if len(changes['change list']) > 0:
+            changes['count'] = len(changes['change list'])
+            changes['changed'] = True
+
+    def set_result_message():
+        for changes in group_results:
+            finish_changes(changes)
+        result['changed'] = any(changes['changed'] for changes in group_results)
+        if module_params['groups'] == None:
+            if len(group_results) > 0:
+                result['message'] = group_results[0]
+        else:
+            result['message'] = group_results
+
+    def exit_module_error(msg):
+        raise GroupKeeperError(msg)
+
+    def plan_members(members_list, group, controller, changes, exclusive=False): #Возвращает план (операции по пользователям, новые участники, лишние участники)
+        controller.get_members_snapshot(group, [member['name'] for member in members_list] if exclusive else None)
+        operations = {}
+        new_members = []
+        for member in members_list:
+            queue = operations.setdefault(member['name'], [])
+            if member['state'].lower() == 'absent':
+                if controller.check_membership(group, member['name']):
+                    controller.delete_member(group, member['name'], queue=queue)
+                    changes['change list'].append({'User removed' : member['name']})
+                continue
+            if member['state'].lower() == 'present':
+                if not controller.check_membership(group, member['name']):
+                    new_members.append(member['name'])
+                    controller.expect_new_member(group, member['name'])
+                    changes['change list'].append({'User added' : member['name']})
+
+                cur_user = controller.get_member_obj(group, member['name'])
+                if member.get('permissions'):
+                    permissions_diff = controller.diff_object(member['permissions'], cur_user.permissions)
+                    if len(permissions_diff) > 0:
+                        cur_user.permissions = controller.list_object_merge(permissions_diff, cur_user.permissions)
+                        controller.push_permissions(group, cur_user.username, cur_user.permissions, queue=queue)
+                        changes['change list'].append({'User permissions' : {member['name'] : permissions_diff}})
+
+                if member['is_admin'] == True:
+                    if member.get('privileges'):
+                        privileges_diff = controller.diff_object(member['privileges'], cur_user.privileges)
+                        if len(privileges_diff) > 0 or not cur_user.is_admin:
+                            cur_user.privileges = controller.list_object_merge(privileges_diff, cur_user.privileges)
+                            controller.push_privileges(group, cur_user.username, cur_user.privileges, queue=queue)
+                            changes['change list'].append({'User privileges' : {member['name'] : privileges_diff}})
+                    elif not cur_user.is_admin:
+                        controller.push_privileges(group, cur_user.username, None, queue=queue)
+                        changes['change list'].append({'User privileges' : {member['name'] : {}}})
+                    cur_user.is_admin = True
+                elif member['is_admin'] == False:
+                    if cur_user.is_admin:
+                        controller.remove_privileges(group, cur_user.username, queue=queue)
+                        changes['change list'].append({'User privileges removed' : member['name']})
+                        cur_user.is_admin = False
+
+                if member.get('admin_title') != None and cur_user.is_admin and not member['admin_title'] == cur_user.admin_title:
+                    controller.set_admin_title(group, cur_user.username, member['admin_title'], queue=queue)
+                    cur_user.admin_title = member['admin_title']
+                    changes['change list'].append({'User admin title' : {member['name'] : member['admin_title']}})
+
+        unlisted = {}
+        if exclusive: #Все, кого нет в users, удаляются из группы
+            unlisted = controller.get_unlisted_members(group, [member['name'] for member in members_list])
+            for name in unlisted:
+                changes['change list'].append({'User removed' : name})
+
+        return operations, new_members, unlisted
+
+    def apply_members(group, controller, changes, plan):
+        if check_mode:
+            return
+        operations, new_members, unlisted = plan
+        errors = controller.add_new_members(group, new_members)
+        errors.update(controller.run_member_operations({username: queue for username, queue in operations.items() if len(queue) > 0 and username not in errors}, group))
+        errors.update(controller.delete_members(group, unlisted))
+        if len(errors) > 0:
+            changes['failed users'] = {username: str(error) for username, error in errors.items()}
+            exit_module_error('Failed to update users: ' + ', '.join(username + ' (' + str(error) + ')' for username, error in errors.items()))
+
+
+    def record_steps(steps, changes):
+        changes['change list'].extend(summary for summary, apply in steps)
+
+    def apply_steps(steps): #Применяет план по порядку. В check mode ничего не делает
+        if not check_mode:
+            for summary, apply in steps:
+                apply()
+
+    def check_rights(controller, group, changes): #Сверяет весь план с нашими правами до первой записи, чтобы не упасть на середине
+        if not group.exists:
+            return
+        required = set(name for summary in changes['change list'] for key in summary if key in REQUIRED_RIGHTS for name in REQUIRED_RIGHTS[key])
+        if group.metadata_message_id != None and group.metadata_editable: #Наше сообщение с метаданными правят на месте, закреплять не нужно
+            required.discard('can_pin_messages')
+        if len(required) == 0:
+            return
+        missing = controller.missing_rights(group, sorted(required))
+        if len(missing) > 0:
+            exit_module_error('Not enough rights in group ' + str(group.title) + ': ' + ', '.join(missing))
+
+    def plan_group(controller, params, group): #Возвращает упорядоченный план [(описание, функция)] для свойств группы
+        steps = []
+        if not params['group_title'] == group.title:
+            group.title = params['group_title']
+            steps.append(({'Group Title' : group.title}, lambda: controller.set_new_title(group)))
+
+        if not params['group_description'] == None and not params['group_description'] == group.description:
+            if len(params['group_description']) > 255:
+                exit_module_error('Description length must be less than 255 symbols')
+            group.description = params['group_description']
+            steps.append(({'Group Description' : group.description}, lambda: controller.set_group_description(group)))
+
+        if not params['group_image'] == None:
+            try:
+                image_hash = controller.get_file_hash(params['group_image'])
+            except OSError as e:
+                exit_module_error('Image ' + params['group_image'] + ' doesn\'t exist.')
+            if not group.image_hash == image_hash:
+                group.image = params['group_image']
+                group.image_hash = image_hash
+                steps.append(({'Group Image': group.image_hash}, lambda: controller.set_new_group_image(group)))
+        return steps
+
+    def plan_default_permissions(controller, params, group): #Права группы по умолчанию. С optimize_permissions - самый частый набор прав пользователей
+        desired = params['default_group_permissions']
+        if desired == None and module_params['optimize_permissions']:
+            desired = controller.most_common_permissions([user['permissions'] for user in params['users']
+                                                          if user['state'].lower() == 'present' and user.get('permissions')])
+        if not desired:
+            return []
+        controller.get_members_snapshot(group, [user['name'] for user in params['users']] if params['exclusive'] else None)
+        permissions_diff = controller.diff_object(desired, controller.get_default_permissions(group))
+        if len(permissions_diff) == 0:
+            return []
+        controller.list_object_merge(permissions_diff, group.chat_permissions)
+        controller.inherit_default_permissions(group)
+        return [({'Group Permissions' : permissions_diff}, lambda: controller.push_default_permissions(group, group.chat_permissions))]
+
+    def group_state(group):
+        return {'exists': group.exists,
+                'title': group.title,
+                'description': group.description,
+                'image_hash': group.image_hash}
+
+    def reconcile_group(controller, params, group=None):
+        changes = new_changes(params['group_title'])
+        if group == None:
+            try:
+                group = controller.get_group_obj(title=params['group_title'],id = params['group_id'])
+            except ValueError as e:
+                exit_module_error(str(e))
+        before = group_state(group)
+
+        steps = []
+        if params['state'].lower() == 'absent':
+            if group.exists:
+                steps.append(({'Group removed' : True}, lambda: controller.remove_group(group)))
+            record_steps(steps, changes)
+            check_rights(controller, group, changes)
+            apply_steps(steps)
+            diffs.append({'before_header': params['group_title'], 'after_header': params['group_title'],
+                          'before': before, 'after': {'exists': False}})
+            return
+
+        if not group.exists:
+            group.title = params['group_title']
+            steps.append(({'Group Created' : True}, lambda: controller.create_new_group(group)))
+        steps.extend(plan_group(controller, params, group))
+        administered = group.rights == None or group.rights.is_owner or group.rights.is_admin #Права не прочитаны только у групп из кэша и новых
+        if group.exists and administered and group.metadata_message_id == None and not any('Group Image' in summary for summary, apply in steps):
+            #Метаданных нет - пишем их один раз, дальше группа находится без поиска по сообщениям
+            steps.append(({'Group Metadata': True}, lambda: controller.add_group_metadata(group)))
+        permission_steps = None
+        if group.exists or check_mode:
+            permission_steps = plan_default_permissions(controller, params, group)
+            steps.extend(permission_steps)
+        record_steps(steps, changes)
+
+        manage_members = len(params['users']) > 0 or params['exclusive']
+        members_plan = None
+        if manage_members and group.exists:
+            members_plan = plan_members(params['users'], group, controller, changes, exclusive=params['exclusive'])
+        check_rights(controller, group, changes)
+        apply_steps(steps)
+        if permission_steps == None: #Права новой группы планируем по настоящим, полученным при создании
+            permission_steps = plan_default_permissions(controller, params, group)
+            record_steps(permission_steps, changes)
+            apply_steps(permission_steps)
+
+        if manage_members:
+            if members_plan == None: #Новую группу сначала создаем, участников планируем уже для нее
+                members_plan = plan_members(params['users'], group, controller, changes, exclusive=params['exclusive'])
+            apply_members(group, controller, changes, members_plan)
+
+        after = group_state(group)
+        after['exists'] = True
+        diffs.append({'before_header': params['group_title'], 'after_header': params['group_title'],
+                      'before': before, 'after': after})
+        if not check_mode:
+            controller.remember_group(group)
+
+    def reconcile_pool_group(pool, params): #Группу обрабатывает один из аккаунтов пула. При переходе к другому аккаунту результаты попытки отбрасываются
+        results_count = len(group_results)
+        diffs_count = len(diffs)
+
+        def attempt(controller, group):
+            del group_results[results_count:]
+            del diffs[diffs_count:]
+            reconcile_group(controller, params, group)
+
+        try:
+            pool.run(params['group_title'], params['group_id'], attempt, owner=params['state'].lower() == 'absent')
+        except ValueError as e:
+            if len(group_results) == results_count:
+                new_changes(params['group_title'])
+            exit_module_error(str(e))
+
+    errors = [] #Ошибка одной группы не останавливает остальные - она записывается в результат этой группы
+    for params in [module_params] if module_params['groups'] == None else module_params['groups']:
+        results_count = len(group_results)
+        unavailable = tg_controller.get_load()[0]
+        try:
+            if unavailable > 0: #Аккаунт под долгим FloodWait - остальные группы отмечаем без запросов, чтобы не продлевать его
+                error = 'Skipped: the account is under FloodWait for ' + str(int(math.ceil(unavailable))) + ' more seconds'
+            elif isinstance(tg_controller, TgControllerPool):
+                reconcile_pool_group(tg_controller, params)
+                continue
+            else:
+                reconcile_group(tg_controller, params)
+                continue
+        except GroupKeeperError as e:
+            error = str(e)
+        except Exception as e: #FloodWait длиннее max_flood_wait и прочие ошибки Telegram - тоже результат со счетчиками, а не traceback
+            error = 'Telegram request failed: ' + (str(e) or repr(e))
+        if len(group_results) == results_count:
+            new_changes(params['group_title'])
+        group_results[-1]['failed'] = True
+        group_results[-1]['msg'] = error
+        errors.append((params['group_title'], error))
+
+    set_result_message()
+    if diff_mode:
+        result['diff'] = diffs
+    collect_request_stats()
+    if len(errors) == 0:
+        return False, None, result
+    if module_params['groups'] == None:
+        return True, errors[0][1], result
+    return True, 'Failed groups: ' + '; '.join(str(title) + ': ' + error for title, error in errors), result
+
+
+def broker_handler(controller, request):
+    failed, msg, result = reconcile(controller, request['params'], request['check_mode'], request['diff'])
+    return {'failed': failed, 'msg': msg, 'result': result}
+
+
+def module_spec(): #Описание параметров для AnsibleModule (и для ArgumentSpecValidator в бенчмарках)
+    group_args = dict(
+        group_title=dict(type='str', required=False),
         group_id=dict(type=int, required=False, default=None),
         group_image=dict(type='str', required=False, default=None),
         group_description=dict(type='str', required=False),
         state=dict(type='str', default='present', required=False, choices=['absent', 'present']),
-        default_group_permissions=dict(type='list', required=False, default=None, options=dict(
+        exclusive=dict(type='bool', required=False, default=False, aliases=['purge_unlisted']),
+        default_group_permissions=dict(type='dict', required=False, default=None, options=dict(
             can_send_messages=dict(type='bool', required=False, default=None),
             can_send_media_messages=dict(type='bool', required=False, default=None),
             can_send_other_messages=dict(type='bool', required=False, default=None),
@@ -150,12 +563,12 @@ def run_module():
             can_pin_messages=dict(type='bool', required=False, default=None)
             )
           ),
-        users=dict(type='list', required=True, options=dict(
+        users=dict(type='list', elements='dict', required=False, default=[], options=dict(
             name=dict(type='str', required=True),
             is_admin=dict(type='bool', required=False, default=False),
             admin_title=dict(type='str', required=False),
             state=dict(type='str', required=False, default='present', choices=['absent', 'present']),
-            permissions=dict(type='list', required=False, default={}, options=dict(
+            permissions=dict(type='dict', required=False, default={}, options=dict(
                 can_send_messages=dict(type='bool', required=False, default=None),
                 can_send_media_messages=dict(type='bool', required=False, default=None),
                 can_send_other_messages=dict(type='bool', required=False, default=None),
@@ -166,7 +579,7 @@ def run_module():
                 can_pin_messages=dict(type='bool', required=False, default=None)
                 )
             ),
-            privileges=dict(type='list', required=False, default=None, options=dict(
+            privileges=dict(type='dict', required=False, default=None, options=dict(
                 can_manage_chat=dict(type='bool', reqired=False, default=None),
                 can_delete_messages=dict(type='bool', required=False, default=None),
                 can_manage_video_chats=dict(type='bool', required=False, default=None),
@@ -182,6 +595,33 @@ def run_module():
         )
     )
 
+    module_args = dict(
+        session_string=dict(type='str', required=False),
+        session_strings=dict(type='list', elements='str', required=False, default=None, no_log=True),
+        concurrency=dict(type='int', required=False, default=8),
+        max_flood_wait=dict(type='int', required=False, default=300),
+        image_hash_cache=dict(type='path', required=False, default=None),
+        state_cache=dict(type='path', required=False, default=None),
+        state_cache_ttl=dict(type='int', required=False, default=86400),
+        state_cache_revalidate=dict(type='bool', required=False, default=True),
+        optimize_permissions=dict(type='bool', required=False, default=False),
+        peer_cache=dict(type='path', required=False, default=None),
+        peer_cache_ttl=dict(type='int', required=False, default=None), #Секунды. По умолчанию TTL Pyrogram (8 часов): username может перейти к другому человеку, дольше - только явно
+        broker=dict(type='bool', required=False, default=False),
+        profile=dict(type='bool', required=False, default=False),
+        profile_file=dict(type='path', required=False, default=None),
+        broker_idle_timeout=dict(type='int', required=False, default=300),
+        groups=dict(type='list', elements='dict', required=False, default=None,
+                    options=dict(group_args, group_title=dict(type='str', required=True))),
+        **group_args
+    )
+
+    return dict(argument_spec=module_args,
+                required_one_of=[['group_title', 'groups'], ['session_string', 'session_strings']],
+                mutually_exclusive=[['groups', name] for name in group_args] + [['session_string', 'session_strings']]) #С groups параметры группы задаются только внутри groups
+
+
+def run_module():
     result = dict(
         changed=False,
         original_message='',
@@ -189,110 +629,49 @@ def run_module():
     )
 
     module = AnsibleModule(
-        argument_spec=module_args,
-        supports_check_mode=True
+        supports_check_mode=True,
+        **module_spec()
     )
 
-    changes = {"changed" : False,
-               "count" : 0,
-               "change list" : []
-               }
-
-
-    def exit_module_error(msg):
+    result['crypto_backend'] = crypto_backend()
+    if result['crypto_backend'] != 'tgcrypto':
+        module.warn('TgCrypto is not installed, Pyrogram falls back to pure Python encryption. Install tgcrypto to speed up uploads and busy sessions.')
+
+    controller_options = dict(concurrency=module.params['concurrency'], max_flood_wait=module.params['max_flood_wait'],
+                              image_hash_cache=module.params['image_hash_cache'], state_cache=module.params['state_cache'],
+                              state_cache_ttl=module.params['state_cache_ttl'], state_cache_revalidate=module.params['state_cache_revalidate'],
+                              peer_cache=module.params['peer_cache'], peer_cache_ttl=module.params['peer_cache_ttl'],
+                              profile=module.params['profile'] or module.params['profile_file'] != None)
+
+    def new_controller(options): #С session_strings - пул аккаунтов с тем же интерфейсом, что нужен reconcile
+        if module.params['session_strings'] != None:
+            return TgControllerPool(module.params['session_strings'], **options)
+        return TgGroupController(module.params['session_string'], **options)
+
+    if module.params['broker'] and module.params['session_strings'] != None:
+        #Брокер держит клиент на свою сессию: у пулов с общим аккаунтом были бы разные брокеры и два клиента на один ключ (AUTH_KEY_DUPLICATED)
+        module.fail_json(msg='broker cannot be used with session_strings, use it with a single session_string', **result)
+
+    if module.params['broker']:
+        try:
+            response = call_broker(module.params['session_string'], controller_options,
+                                   {'params': module.params, 'check_mode': module.check_mode, 'diff': module._diff},
+                                   new_controller, broker_handler,
+                                   idle_timeout=module.params['broker_idle_timeout'])
+        except Exception as e:
+            module.fail_json(msg='Broker is unavailable: ' + str(e), **result)
+        failed, msg, result = response['failed'], response['msg'], dict(result, **response['result'])
+    else:
+        try:
+            tg_controller = new_controller(controller_options)
+        except Exception as e:
+            module.fail_json(msg=str(e), **result)
+        with tg_controller:
+            failed, msg, result = reconcile(tg_controller, module.params, module.check_mode, module._diff)
+
+    if failed:
         module.fail_json(msg=msg, **result)
-
-    def exit_module():
-        if len(changes['change list']) > 0:
-            changes['count'] = len(changes['change list'])
-            changes['changed'] = True
-        result['message'] = changes
-        module.exit_json(**result)
-
-    def process_members(members_list, group, controller):
-        for member in members_list:
-            if member['state'].lower() == 'absent':
-                if controller.check_membership(group, member['name']):
-                    controller.delete_member(group, member['name'])
-                    continue
-            if member['state'].lower() == 'present':
-                if not controller.check_membership(group, member['name']):
-                    controller.add_new_member(group, member['name'])
-
-                cur_user = controller.get_member_obj(group, member['name'])
-                if 'permissions' in member and len(member['permissions']) > 0:
-                    cur_user.permissions = controller.list_object_merge(member['permissions'], cur_user.permissions)
-                    controller.push_permissions(group, cur_user.username, cur_user.permissions)
-
-                if member['is_admin'] == True:
-                    if 'privileges' in member and len(member['privileges']) > 0:
-                        cur_user.privileges = controller.list_object_merge(member['privileges'], cur_user.privileges)
-                        controller.push_privileges(group, cur_user.username, cur_user.privileges)
-                    elif not cur_user.is_admin and (not 'privileges' in member or len(member['privileges']) == 0):
-                        controller.push_privileges(group, cur_user.username, None)
-                elif member['is_admin'] == False:
-                    if cur_user.is_admin:
-                        controller.remove_privileges(group, cur_user.username)
-
-                if 'admin_title' in member and (member['is_admin'] or cur_user.is_admin):
-                    controller.set_admin_title(group, cur_user.username, member['admin_title'])
-
-
-    def process_group(controller, params, group):
-        if not params['group_title'] == group.title:
-            group.title = params['group_title']
-            controller.set_new_title(group)
-            changes['change list'].append({'Group Title' : group.title})
-
-        if not params['group_description'] == group.description:
-            group.description = params['group_description']
-            changes['change list'].append({'Group Description' : group.description})
-            try:
-                controller.set_group_description(group)
-            except ValueError:
-                exit_module_error('Description length must be less than 255 symbols')
-            
-        if not params['group_image'] == None:
-            try:
-                image = controller.open_image_file(params['group_image'])
-            except Exception as e:
-                exit_module_error('Image ' + params['group_image'] + ' doesn\'t exist.')
-            image_hash = controller.get_image_hash(image)
-            if not group.image_hash == image_hash:
-                group.image = image
-                group.image_hash = image_hash
-                controller.set_new_group_image(group)
-                changes['change list'].append({'Group Image': group.image_hash})
-                controller.close_image(group.image)
-    
-    try:
-        tg_controller = TgGroupController(module.params['session_string'])
-    except Exception as e:
-        exit_module_error(e)
-
-    group = tg_controller.get_group_obj(title=module.params['group_title'],id = module.params['group_id'])
-
-    if module.params['state'].lower() == 'absent':
-        if group.exists:
-            tg_controller.remove_group(group)
-            changes['change list'].append({'Group removed' : True})
-            exit_module()
-        else:
-            exit_module()
-    elif module.params['state'].lower() == 'present':
-        if not group.exists:
-            new_group = tg_controller.create_new_group(group)
-            process_group(tg_controller, module.params, new_group)
-            changes['change list'].append({'Group Created' : True})
-        else:
-            process_group(tg_controller, module.params, group)
-
-    if len(module.params['users']) > 0:
-        process_members(module.params['users'], group, tg_controller)
-
-    
-
-    exit_module()
+    module.exit_json(**result)
 
 def main():
     run_module()